@@ -0,0 +1,200 @@
+# Copyright Michael Kukar 2023
+# measures a mood change, a key press and a display render against local fakes (see fakes.py)
+# no api keys, network or e-paper panel needed, so it can run in CI on a plain linux box
+# run with python benchmarks/end_to_end_benchmark.py --speed 0.1 --max-p99 mood_change=5,key_press=1,render=2
+
+import os, sys
+import argparse
+import contextlib
+import io
+import json
+import logging
+import math
+import random
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import fakes
+
+# real world latencies of each service in seconds, scaled by --speed
+LLM_FIRST_TOKEN_SECONDS = 0.6
+LLM_TOKEN_SECONDS = 0.02
+DALLE_SECONDS = 3.0
+SPOTIFY_SECONDS = 0.15
+HTTP_SECONDS = 0.2
+EPD_FULL_REFRESH_SECONDS = 2.0
+EPD_PARTIAL_REFRESH_SECONDS = 0.4
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End to end latency benchmark for beba using local fakes")
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--speed', type=float, default=1.0, help="multiplies every fake latency, use less than 1 for quicker runs")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="chance (0-1) of each fake call failing")
+    parser.add_argument('--cold-cache', action='store_true', help="clear the mood changer cache before every mood change")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--max-p99', default='', help="fail if a p99 is over its limit in seconds, such as mood_change=5,key_press=1")
+    parser.add_argument('--stage-metrics', action='store_true', help="print the per stage metrics collected during the run")
+    parser.add_argument('--verbose', action='store_true', help="show beba's log output")
+    return parser.parse_args()
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1))]
+
+# runs counts every attempt, the percentiles cover the attempts that produced a latency
+def summarize(name, runs, latencies, failures):
+    return {
+        'name': name,
+        'count': runs,
+        'failures': failures,
+        'p50': percentile(latencies, 0.5) if latencies else None,
+        'p99': percentile(latencies, 0.99) if latencies else None,
+        'mean': sum(latencies) / len(latencies) if latencies else None
+    }
+
+def set_environment(temp_dir):
+    os.environ.update({
+        'OPENAI_API_KEY': 'benchmark',
+        'NYTIMES_API_KEY': 'benchmark',
+        'NYTIMES_REQUESTS_PER_MINUTE': '1000000',
+        'MOOD_TOPICS_ENABLED': 'weather,books,news',
+        'WEATHER_ZIP_CODE': '12345',
+        'WEATHER_COUNTRY_CODE': 'US',
+        'SPOTIFY_DEVICE_NAME': 'BeBa',
+        'MOOD_CHANGER_CACHE_PATH': ''
+    })
+    # features that keep state on disk write to the temp dir instead of the repo
+    for name in ['LLM_MEMO_PATH', 'PLAYLIST_INDEX_PATH']:
+        if os.getenv(name):
+            os.environ[name] = str(Path(temp_dir) / Path(os.getenv(name)).name)
+
+def build_controller(args, stub_url, spotify):
+    import music
+    from mood_changer import WeatherMoodChanger, BooksMoodChanger, NewsMoodChanger, MoviesMoodChanger
+    from controller import Controller
+    from mood import Mood
+    from mood_pipeline import MoodPipeline
+
+    for mood_changer_class in [BooksMoodChanger, NewsMoodChanger, MoviesMoodChanger]:
+        mood_changer_class.BASE_ENDPOINT = stub_url
+    WeatherMoodChanger.GEOCODE_ENDPOINT = WeatherMoodChanger.POINTS_ENDPOINT = stub_url
+    music.spotipy.Spotify = lambda **kwargs: spotify
+    music.SpotifyOAuth = lambda **kwargs: None
+    music.CacheFileHandler = lambda **kwargs: None
+
+    controller = Controller('benchmark')
+    controller.llm = fakes.FakeLLM(first_token_seconds=LLM_FIRST_TOKEN_SECONDS * args.speed, token_seconds=LLM_TOKEN_SECONDS * args.speed, error_rate=args.error_rate)
+    controller.mood = Mood(controller.llm)
+    controller.mood.schedule_mood_changer_refreshes(controller.scheduler, controller.is_quiet_hours_now)
+    controller.scheduler.start()
+    controller.music = music.Music(controller.llm)
+    controller.mood_pipeline = MoodPipeline(controller.mood, controller.music)
+    controller.components_ready.set()
+    return controller
+
+def benchmark_mood_changes(args, controller):
+    from mood_changer import MoodChanger
+    latencies, failures = [], 0
+    for _ in range(args.iterations):
+        if args.cold_cache:
+            MoodChanger.cache = None
+        controller.music.playlist = None
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            controller.determine_mood_and_play()
+        latencies.append(time.monotonic() - start)
+        if controller.music.playlist is None:
+            failures += 1
+    return summarize('mood_change', args.iterations, latencies, failures)
+
+# time from the key press until spotify is asked to skip, includes the dispatcher's debounce
+def benchmark_key_presses(args, controller, spotify):
+    latencies, failures = [], 0
+    for _ in range(args.iterations):
+        spotify.track_changed.clear()
+        start = time.monotonic()
+        controller.on_keypress(controller.NEXT_KEY)
+        if spotify.track_changed.wait(timeout=30.0):
+            latencies.append(time.monotonic() - start)
+        else:
+            failures += 1
+        # let the press finish so the next one is not folded into it
+        time.sleep(controller.dispatcher.debounce_seconds)
+    return summarize('key_press', args.iterations, latencies, failures)
+
+# alternates new moods (icon lookup or generation and a full refresh) with new tracks (partial refresh)
+def benchmark_renders(args, controller, temp_dir):
+    from epaper_display import EPaperDisplay
+    from PIL import ImageFont
+
+    mood_img_dir = Path(temp_dir) / 'moods'
+    shutil.copytree(EPaperDisplay.MOOD_IMG_DIR, mood_img_dir)
+    EPaperDisplay.MOOD_IMG_DIR = mood_img_dir
+    if not EPaperDisplay.FONT_PATH.exists():
+        # the font ships with the waveshare library, which is not installed off the pi
+        EPaperDisplay.get_font = lambda self, size: ImageFont.load_default()
+    screen = EPaperDisplay(controller.llm, 'benchmark')
+    screen.image_llm = fakes.FakeDallE(fakes.Latency(DALLE_SECONDS * args.speed, args.error_rate))
+    latencies, failures = [], 0
+    mood = random.choice(fakes.MOODS)
+    for i in range(args.iterations):
+        if i % 2 == 0:
+            mood = random.choice(fakes.MOODS)
+        start = time.monotonic()
+        try:
+            screen.render(mood, 'Benchmark Playlist', 'Track {0}'.format(i), 'Benchmark Band', fakes.REASONING, fakes.REASONING)
+        except Exception:
+            failures += 1
+        latencies.append(time.monotonic() - start)
+    return summarize('render', args.iterations, latencies, failures)
+
+def check_limits(results, max_p99):
+    failed = []
+    for setting in [setting for setting in max_p99.split(',') if '=' in setting]:
+        name, limit = setting.split('=', 1)
+        for result in results:
+            if result['name'] == name.strip() and (result['p99'] is None or result['p99'] > float(limit)):
+                failed.append("{0} p99 {1} is over the limit of {2}s".format(name.strip(), result['p99'], limit))
+    return failed
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    logger = logging.getLogger('beba')
+    logger.setLevel(logging.DEBUG if args.verbose else logging.CRITICAL)
+    if args.verbose:
+        logger.addHandler(logging.StreamHandler())
+    temp_dir = tempfile.mkdtemp(prefix='beba_benchmark_')
+    stub = fakes.StubServer(fakes.Latency(HTTP_SECONDS * args.speed, args.error_rate)).start()
+    try:
+        set_environment(temp_dir)
+        fakes.install_fake_epd(EPD_FULL_REFRESH_SECONDS * args.speed, EPD_PARTIAL_REFRESH_SECONDS * args.speed)
+        spotify = fakes.FakeSpotify(fakes.Latency(SPOTIFY_SECONDS * args.speed, args.error_rate))
+        controller = build_controller(args, stub.get_url(), spotify)
+        results = [
+            benchmark_mood_changes(args, controller),
+            benchmark_key_presses(args, controller, spotify),
+            benchmark_renders(args, controller, temp_dir)
+        ]
+        controller.dispatcher.shutdown()
+        controller.scheduler.stop()
+    finally:
+        stub.stop()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    print("{0:<14} {1:>6} {2:>9} {3:>9} {4:>9} {5:>9}".format('scenario', 'runs', 'failures', 'p50', 'p99', 'mean'))
+    for result in results:
+        print("{0:<14} {1:>6} {2:>9} {3:>8.3f}s {4:>8.3f}s {5:>8.3f}s".format(result['name'], result['count'], result['failures'], result['p50'] or 0.0, result['p99'] or 0.0, result['mean'] or 0.0))
+    if args.stage_metrics:
+        from metrics import metrics
+        print(metrics.render())
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+    failed = check_limits(results, args.max_p99)
+    for failure in failed:
+        print("FAIL: {0}".format(failure))
+    sys.exit(1 if failed else 0)
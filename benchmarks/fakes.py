@@ -0,0 +1,249 @@
+# Copyright Michael Kukar 2023
+# local stand-ins for openai, dall-e, spotify, nytimes, noaa and the e-paper panel used by the benchmarks
+# every fake sleeps for its configured latency and fails at its configured error rate
+
+import json
+import random
+import sys
+import time
+import types
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Event, Thread
+from urllib.parse import urlsplit
+
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+MOOD_IMG_DIR = Path(__file__).resolve().parent.parent / "resources" / "img" / "moods"
+
+# a mix of moods that already have icons and moods that need one generated
+MOODS = ['Happy', 'Angry', 'Confused', 'Sleepy', 'Wistful', 'Sunny', 'Restless', 'Nostalgic']
+SEARCH_QUERIES = ['60s surf rock with the beach boys', 'moody lofi beats for a rainy day', 'upbeat 80s synth pop',
+                  'slow jazz piano for late nights', 'angry 90s grunge like nirvana', 'calm acoustic folk']
+# reasoning is most of the generated tokens, same as with gpt-4
+REASONING = ("the information I was given paints a picture that I keep coming back to, and the longer I think about it "
+             "the more it colours everything else I notice today, from the weather outside to the stories I have been reading, "
+             "so this feels like the most honest way to describe where my head is right now")
+
+
+class FakeServiceError(Exception):
+
+    def __init__(self, service):
+        super().__init__("Simulated {0} failure".format(service))
+        self.http_status = 500
+
+
+class Latency:
+
+    def __init__(self, seconds, error_rate=0.0):
+        self.seconds = seconds
+        self.error_rate = error_rate
+
+    def wait(self, service):
+        time.sleep(self.seconds)
+        if random.random() < self.error_rate:
+            raise FakeServiceError(service)
+
+
+# answers every beba prompt with a plausible response, streamed a word at a time like a chat model
+class FakeLLM(LLM):
+
+    model_name: str = 'fake-gpt-4'
+    first_token_seconds: float = 0.6
+    token_seconds: float = 0.02
+    error_rate: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return 'fake'
+
+    def respond(self, prompt):
+        if 'image based on the following mood' in prompt:
+            return 'A cartoon sun smiling over a calm sea'
+        if 'JSON object' in prompt:
+            return json.dumps({'mood': random.choice(MOODS), 'mood_reason': REASONING,
+                               'search_query': random.choice(SEARCH_QUERIES), 'search_query_reason': REASONING})
+        if 'what type of music would you search for' in prompt:
+            return '{0}: {1}'.format(random.choice(SEARCH_QUERIES), REASONING)
+        return '{0}: {1}'.format(random.choice(MOODS), REASONING)
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        text = self.respond(prompt)
+        Latency(self.first_token_seconds + self.token_seconds * len(text.split()), self.error_rate).wait('llm')
+        return text
+
+    def _stream(self, prompt, stop=None, run_manager=None, **kwargs):
+        text = self.respond(prompt)
+        Latency(self.first_token_seconds, self.error_rate).wait('llm')
+        for word in text.split(' '):
+            time.sleep(self.token_seconds)
+            yield GenerationChunk(text=word + ' ')
+
+
+# stands in for DallEAPIWrapper, hands back a file url to a bundled icon that urlretrieve can copy
+class FakeDallE:
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def run(self, prompt):
+        self.latency.wait('dall-e')
+        return sorted(MOOD_IMG_DIR.glob('*.png'))[0].as_uri()
+
+
+# stands in for spotipy.Spotify with just the calls beba makes
+class FakeSpotify:
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.is_playing = False
+        self.track_number = 0
+        self.track_changed = Event()
+
+    def devices(self):
+        self.latency.wait('spotify')
+        return {'devices': [{'id': 'benchmark-device', 'name': 'BeBa'}]}
+
+    def search(self, q, type='playlist', limit=10, offset=0):
+        self.latency.wait('spotify')
+        items = []
+        for i in range(limit):
+            # spotify returns null for playlists that are no longer available
+            items.append(None if i == 0 else {
+                'uri': 'spotify:playlist:{0}-{1}'.format(abs(hash(q)) % 1000, offset + i),
+                'name': '{0} #{1}'.format(q, offset + i),
+                'tracks': {'total': random.choice([3, 25, 60, 150])},
+                'owner': {'id': random.choice(['spotify', 'someone'])}
+            })
+        return {'playlists': {'items': items}}
+
+    def playlist(self, uri, fields=None):
+        self.latency.wait('spotify')
+        return {'uri': uri, 'name': uri, 'followers': {'total': random.randrange(100000)}}
+
+    def currently_playing(self):
+        self.latency.wait('spotify')
+        return {'is_playing': self.is_playing, 'progress_ms': 1000,
+                'item': {'name': 'Track {0}'.format(self.track_number), 'artists': [{'name': 'Benchmark Band'}], 'duration_ms': 180000}}
+
+    def start_playback(self, context_uri=None, device_id=None):
+        self.latency.wait('spotify')
+        self.is_playing = True
+
+    def pause_playback(self, device_id=None):
+        self.latency.wait('spotify')
+        self.is_playing = False
+
+    def next_track(self, device_id=None):
+        self.latency.wait('spotify')
+        self.track_number += 1
+        self.track_changed.set()
+
+    def previous_track(self, device_id=None):
+        self.latency.wait('spotify')
+        self.track_number = max(0, self.track_number - 1)
+        self.track_changed.set()
+
+
+# local http server answering the nytimes endpoints and the geocode, points and forecast endpoints of the weather lookup
+class StubServer:
+
+    FORECAST_PATH = '/noaa/forecasts'
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.server = None
+
+    def get_response(self, path):
+        if path.endswith('/lists/names.json'):
+            return {'results': [{'list_name_encoded': 'hardcover-fiction'}, {'list_name_encoded': 'young-adult'}]}
+        if '/lists/current/' in path:
+            return {'results': {'books': [{'title': 'A Benchmark Novel', 'author': 'A. Writer', 'description': 'A story about waiting on slow networks'}]}}
+        if '/topstories/' in path:
+            return {'results': [{'section': 'technology', 'title': 'Latency Falls', 'abstract': 'Engineers measure where the seconds go'}]}
+        if '/reviews/picks.json' in path:
+            return {'results': [{'display_title': 'The Benchmark', 'summary_short': 'A film about fast startups'}]}
+        if path == '/search':
+            return [{'lat': '40.0', 'lon': '-75.0'}]
+        if path.startswith('/points/'):
+            return {'properties': {'forecastHourly': "{0}{1}/{2}".format(self.get_url().rstrip('/'), self.FORECAST_PATH, path[len('/points/'):])}}
+        if path.startswith(self.FORECAST_PATH):
+            return {'properties': {'updateTime': datetime.now(timezone.utc).isoformat(),
+                                   'periods': [{'shortForecast': random.choice(['Sunny', 'Rain Showers', 'Partly Cloudy'])}]}}
+        return None
+
+    def start(self):
+        stub = self
+
+        class StubHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                try:
+                    stub.latency.wait('http')
+                except FakeServiceError:
+                    self.send_error(500)
+                    return
+                response = stub.get_response(urlsplit(self.path).path)
+                if response is None:
+                    self.send_error(404)
+                    return
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        Thread(target=self.server.serve_forever, args=(), name='stub_server', daemon=True).start()
+        return self
+
+    def get_url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+
+
+# registers a waveshare_epd.epd2in9_V2 module whose panel only sleeps for as long as a real refresh takes
+def install_fake_epd(full_refresh_seconds, partial_refresh_seconds):
+
+    class EPD:
+        width = 128
+        height = 296
+
+        def __init__(self):
+            self.full_refreshes = 0
+            self.partial_refreshes = 0
+
+        def init(self):
+            pass
+
+        def Clear(self, color):
+            time.sleep(full_refresh_seconds)
+
+        def display(self, buffer):
+            time.sleep(full_refresh_seconds)
+            self.full_refreshes += 1
+
+        def display_Base(self, buffer):
+            self.display(buffer)
+
+        def display_Partial(self, buffer):
+            time.sleep(partial_refresh_seconds)
+            self.partial_refreshes += 1
+
+        def sleep(self):
+            pass
+
+    epd_module = types.ModuleType('waveshare_epd.epd2in9_V2')
+    epd_module.EPD = EPD
+    package = types.ModuleType('waveshare_epd')
+    package.epd2in9_V2 = epd_module
+    sys.modules['waveshare_epd'] = package
+    sys.modules['waveshare_epd.epd2in9_V2'] = epd_module
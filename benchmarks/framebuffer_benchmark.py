@@ -0,0 +1,58 @@
+# Copyright Michael Kukar 2023
+# compares packing a rendered frame into the e-paper buffer
+# run with python benchmarks/framebuffer_benchmark.py
+
+import os, sys
+import random
+import timeit
+from PIL import Image, ImageDraw
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from framebuffer import FrameBufferPacker
+
+EPD_WIDTH = 128
+EPD_HEIGHT = 296
+ITERATIONS = 50
+
+# per pixel packing loop from the waveshare epd2in9_V2 driver
+def legacy_getbuffer(image):
+    buf = [0xFF] * (int(EPD_WIDTH/8) * EPD_HEIGHT)
+    image_monocolor = image.convert('1')
+    imwidth, imheight = image_monocolor.size
+    pixels = image_monocolor.load()
+    for y in range(imheight):
+        for x in range(imwidth):
+            if pixels[x, y] == 0:
+                buf[int((x + y * EPD_WIDTH) / 8)] &= ~(0x80 >> (x % 8))
+    return buf
+
+def legacy_pack(frame):
+    return legacy_getbuffer(frame.transpose(method=Image.ROTATE_180))
+
+def tobytes_pack(frame):
+    return bytearray(frame.transpose(method=Image.ROTATE_180).convert('1').tobytes('raw'))
+
+def make_frame():
+    frame = Image.new('1', (EPD_WIDTH, EPD_HEIGHT), 255)
+    draw = ImageDraw.Draw(frame)
+    for i in range(20):
+        draw.text((35, 115 + i * 9), 'BeBa benchmark line {0}'.format(i), fill = 0)
+    random.seed(0)
+    for _ in range(2000):
+        draw.point((random.randrange(EPD_WIDTH), random.randrange(EPD_HEIGHT // 3)), fill = 0)
+    return frame
+
+if __name__ == "__main__":
+    frame = make_frame()
+    packer = FrameBufferPacker(EPD_WIDTH, EPD_HEIGHT)
+    expected = bytes(legacy_pack(frame))
+    assert bytes(tobytes_pack(frame)) == expected
+    assert bytes(packer.pack(frame, rotate_180=True)) == expected
+    results = {
+        'legacy (transpose + per pixel loop)': timeit.timeit(lambda: legacy_pack(frame), number=ITERATIONS),
+        'transpose + tobytes': timeit.timeit(lambda: tobytes_pack(frame), number=ITERATIONS),
+        'FrameBufferPacker (folded rotation)': timeit.timeit(lambda: packer.pack(frame, rotate_180=True), number=ITERATIONS),
+    }
+    baseline = results['legacy (transpose + per pixel loop)']
+    for name, total in results.items():
+        print("{0:<40} {1:>10.1f}us per frame {2:>8.1f}x".format(name, total / ITERATIONS * 1e6, baseline / total))
@@ -0,0 +1,108 @@
+# Copyright Michael Kukar 2023
+
+import logging
+import random
+import time
+from threading import Event, Lock, Thread
+
+from http_client import RateLimitExceeded
+
+logger = logging.getLogger('beba')
+
+# articles from every section, fetched in the background and kept in one flat list
+# drawing an article is a random index into that list and never waits on the network once the pool is filled
+# a section is only fetched again once its articles are refresh_seconds old, one at a time and at least
+# refresh_seconds / len(sections) apart, so the pool costs at most one request per section per refresh
+class ArticlePool:
+
+    REFRESH_SECONDS = 3 * 60 * 60
+
+    def __init__(self, name, sections, fetch_section, is_valid, refresh_seconds=REFRESH_SECONDS, load_section=None):
+        self.name = name
+        self.sections = list(dict.fromkeys(sections)) # drops duplicates, keeps the order
+        self.fetch_section = fetch_section
+        self.load_section = load_section # (articles, fetched_at) without the network, such as from a cache kept over restarts
+        self.is_valid = is_valid
+        self.refresh_seconds = refresh_seconds
+        self.section_articles = {} # section -> valid articles, kept until a newer fetch replaces them
+        # section -> epoch seconds it was last fetched or tried, so the age carries over restarts
+        # a failed or empty fetch counts too, otherwise one bad section would be fetched over and over
+        self.checked_at = {}
+        self.articles = [] # flat list rebuilt after every section, swapped in whole so readers never see it half built
+        self.filled = Event()
+        self.lock = Lock()
+        self.scheduler = None
+        self.is_paused = None
+
+    # the scheduler wakes the pool when the next section is due, is_paused (such as quiet hours) skips fetching
+    def start(self, scheduler, is_paused=None):
+        with self.lock:
+            if self.scheduler is not None:
+                return self
+            self.scheduler = scheduler
+            self.is_paused = is_paused
+        if self.load_section is not None:
+            for section in self.sections:
+                self.load(section)
+        self.schedule_next()
+        return self
+
+    def load(self, section):
+        try:
+            cached = self.load_section(section)
+        except Exception as e:
+            logger.warning("Could not load cached {0} section {1} due to {2}".format(self.name, section, e))
+            return
+        if cached is not None:
+            articles, fetched_at = cached
+            self.checked_at[section] = fetched_at
+            self.set_section(section, articles)
+
+    # sections never fetched go first, then the one fetched longest ago
+    def get_next_section(self):
+        return min(self.sections, key=lambda section: self.checked_at.get(section, 0.0))
+
+    def schedule_next(self, delay_seconds=0.0):
+        stale_in_seconds = self.checked_at.get(self.get_next_section(), 0.0) + self.refresh_seconds - time.time()
+        # the fetch runs on its own thread so a slow request never holds up the scheduler's other jobs
+        self.scheduler.schedule_in(max(delay_seconds, stale_in_seconds), "{0}_pool".format(self.name),
+                                   lambda due: Thread(target=self.refresh, args=(), name="{0}_pool".format(self.name), daemon=True).start())
+
+    def refresh(self):
+        try:
+            if self.is_paused is not None and self.is_paused():
+                logger.debug("Not fetching {0} while paused".format(self.name))
+            else:
+                self.update_section(self.get_next_section())
+        finally:
+            self.schedule_next(self.refresh_seconds / len(self.sections))
+
+    def update_section(self, section):
+        self.checked_at[section] = time.time()
+        try:
+            articles = self.fetch_section(section)
+        except RateLimitExceeded:
+            logger.debug("Rate limited fetching {0} section {1}, trying again next time round".format(self.name, section))
+            return
+        except Exception as e:
+            logger.warning("Could not fetch {0} section {1} due to {2}, keeping its previous articles".format(self.name, section, e))
+            return
+        self.set_section(section, articles)
+
+    def set_section(self, section, articles):
+        articles = [article for article in (articles or []) if self.is_valid(article)]
+        if len(articles) == 0:
+            logger.debug("No usable articles in {0} section {1}".format(self.name, section))
+            return
+        with self.lock:
+            self.section_articles[section] = articles
+            self.articles = [article for section_articles in self.section_articles.values() for article in section_articles]
+        self.filled.set()
+        logger.debug("{0} pool has {1} articles from {2} sections".format(self.name, len(self.articles), len(self.section_articles)))
+
+    # only the very first draw can wait, for the first section of the first fetch
+    def draw(self, timeout=None):
+        if not self.filled.wait(timeout):
+            raise LookupError("No {0} articles fetched yet".format(self.name))
+        articles = self.articles
+        return articles[random.randrange(len(articles))]
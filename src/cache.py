@@ -0,0 +1,114 @@
+# Copyright Michael Kukar 2023
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Lock, Timer
+
+logger = logging.getLogger('beba')
+
+# least recently used cache where each entry expires after its own ttl
+# if a path is given, entries are persisted to a json file so they survive restarts
+# writes are coalesced, a change schedules one save shortly after instead of rewriting the file every time
+# a get only moves its entry up in memory, the new order is written with the next change or flush
+class TTLCache:
+
+    SAVE_DELAY_SECONDS = 1.0
+
+    def __init__(self, max_entries=128, path=None, save_delay_seconds=SAVE_DELAY_SECONDS):
+        self.max_entries = max_entries
+        self.path = path
+        self.save_delay_seconds = save_delay_seconds
+        self.entries = OrderedDict() # key -> [expires_at (epoch seconds or None), value]
+        self.lock = Lock()
+        self.save_lock = Lock() # only one save writes the temp file and replaces the cache at a time
+        self.save_timer = None
+        if self.path is not None:
+            self.load()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] is not None and entry[0] < time.time():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    # ttl_seconds of None never expires, entry can still be evicted when the cache is full
+    # returns the (key, value) of every entry evicted to make room
+    def set(self, key, value, ttl_seconds=None):
+        with self.lock:
+            self.entries[key] = [time.time() + ttl_seconds if ttl_seconds is not None else None, value]
+            self.entries.move_to_end(key)
+            evicted = self.evict()
+        self.save()
+        return evicted
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        self.save()
+
+    # snapshot of the entries that have not expired, least recently used first
+    def items(self):
+        now = time.time()
+        with self.lock:
+            return [(key, entry[1]) for key, entry in self.entries.items() if entry[0] is None or entry[0] >= now]
+
+    def evict(self):
+        now = time.time()
+        for key in [k for k, entry in self.entries.items() if entry[0] is not None and entry[0] < now]:
+            del self.entries[key]
+        evicted = []
+        while len(self.entries) > self.max_entries:
+            evicted_key, entry = self.entries.popitem(last=False)
+            evicted.append((evicted_key, entry[1]))
+            logger.debug("Evicted {0} from cache".format(evicted_key))
+        return evicted
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                stored_entries = json.load(f)
+            with self.lock:
+                for key, entry in stored_entries:
+                    self.entries[key] = entry
+                self.evict()
+            logger.debug("Loaded {0} cache entries from {1}".format(len(self.entries), self.path))
+        except Exception as e:
+            logger.warning("Could not load cache from {0} due to {1}, starting empty".format(self.path, e))
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            if self.save_timer is not None:
+                return
+            self.save_timer = Timer(self.save_delay_seconds, self.flush)
+            self.save_timer.start()
+
+    def flush(self):
+        if self.path is None:
+            return
+        with self.save_lock:
+            with self.lock:
+                # changes from here on schedule another save
+                self.save_timer = None
+                data = json.dumps([[key, entry] for key, entry in self.entries.items()])
+            try:
+                # write then rename so a crash never leaves a half written cache
+                tmp_path = "{0}.tmp".format(self.path)
+                with open(tmp_path, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.warning("Could not save cache to {0} due to {1}".format(self.path, e))
@@ -0,0 +1,46 @@
+# Copyright Michael Kukar 2023
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+logger = logging.getLogger('beba')
+
+# runs key commands on a small fixed pool of threads
+# each command type has at most one run waiting, presses that arrive while it waits are folded into it
+# so five quick presses of next become a single run that is told to skip five times
+class CommandDispatcher:
+
+    MAX_WORKERS = 3
+    DEBOUNCE_SECONDS = 0.3
+
+    def __init__(self, max_workers=MAX_WORKERS, debounce_seconds=DEBOUNCE_SECONDS):
+        self.debounce_seconds = debounce_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='command')
+        self.pending = {} # command name -> presses waiting to run
+        self.lock = Lock()
+
+    # handler is called with the number of presses it is handling
+    def dispatch(self, name, handler):
+        with self.lock:
+            if name in self.pending:
+                self.pending[name] += 1
+                logger.debug("Folded {0} into the waiting run ({1} presses)".format(name, self.pending[name]))
+                return
+            self.pending[name] = 1
+        self.executor.submit(self.run, name, handler)
+
+    def run(self, name, handler):
+        # give repeated presses a moment to arrive so they run as one
+        time.sleep(self.debounce_seconds)
+        with self.lock:
+            count = self.pending.pop(name)
+        try:
+            handler(count)
+        except Exception as e:
+            logger.error("Command {0} failed".format(name))
+            logger.error(e)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
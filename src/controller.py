@@ -4,15 +4,17 @@ from dotenv import load_dotenv
 import logging
 from logging.handlers import RotatingFileHandler
 import os
-from langchain_openai import ChatOpenAI
 from sshkeyboard import listen_keyboard, stop_listening
-from threading import Thread, Timer, Lock
-from datetime import datetime
+from threading import Thread, Lock, Event
+from datetime import datetime, timedelta
+from concurrent.futures import wait
+import time
 
-from mood import Mood
-from music import Music
-if os.name != 'nt': # don't import if windows
-    from epaper_display import EPaperDisplay
+from startup_profiler import startup_profiler
+from command_dispatcher import CommandDispatcher
+from scheduler import Scheduler
+from metrics import metrics
+from mood_pipeline import MoodPipeline, MoodPipelineCancelled, CancellationToken
 
 logger = logging.getLogger('beba')
 
@@ -40,36 +42,135 @@ class Controller:
     quiet_hours_start = None
     quiet_hours_end = None
 
+    # changes that arrive within this window are drawn in a single refresh
+    DISPLAY_COALESCE_SECONDS = 0.5
+    # longest the display goes without checking spotify, catches changes made outside of beba
+    DISPLAY_MAX_IDLE_SECONDS = 300.0
+    # wake up a moment after quiet hours start or end so the clock is surely past the boundary
+    QUIET_HOURS_MARGIN_SECONDS = 1.0
+    # wait a little past the predicted end of a track so spotify has moved on
+    TRACK_CHANGE_MARGIN_SECONDS = 1.0
+    # how long after starting a playlist or skipping the new track is read for the history
+    TRACK_SETTLE_SECONDS = 2.0
+
+    fast_startup = False
+    mood_plan_mode = False
+    llm_streaming = False
+
+    mood_prefetcher = None
+    # how long before the mood timer fires the next mood is prepared
+    MOOD_PREFETCH_LEAD_MINUTES = 5.0
+    mood_prefetch_lead_minutes = MOOD_PREFETCH_LEAD_MINUTES
+    # longest the info key waits for reasoning that is still streaming in
+    REASONING_WAIT_SECONDS = 30.0
+
     mood_lock = Lock()
+    mood_request_lock = Lock()
+    mood_request_token = None
+    mood_pipeline = None
+    history = None
     display_lock = Lock()
+    display_changed = Event()
+    components_ready = Event()
 
     def __init__(self, version):
         self.version_str = version
+        self.dispatcher = CommandDispatcher()
+        self.scheduler = Scheduler()
 
     def setup(self):
         load_dotenv(os.path.join(os.path.abspath(os.path.dirname(__file__)), '../.env'))
         self.setup_logger()
         self.load_key_configuration()
         logger.info("Setting up...")
-        self.llm = ChatOpenAI(
-            model=self.MODEL,
-            temperature=0.9,
-            max_tokens=2000,
-            openai_api_key=os.getenv('OPENAI_API_KEY')
-        )
-        self.mood = Mood(self.llm)
-        self.music = Music(self.llm)
         self.startup_message()
-        if os.getenv('RASPBERRY_PI_SCREEN') is not None and os.getenv('RASPBERRY_PI_SCREEN').lower() == "true":
-            logger.info("Setting up screen...")
-            self.screen = EPaperDisplay(self.llm, self.version_str)
-            self.screen_enabled = True
         if os.getenv('QUIET_HOURS') is not None and os.getenv('QUIET_HOURS').lower() == "true":
             logger.info("Enabling quiet hours...")
             self.quiet_hours_enabled = True
             self.parse_quiet_hours()
+        if os.getenv('FAST_STARTUP') is not None and os.getenv('FAST_STARTUP').lower() == "true":
+            if os.path.exists(os.path.join(os.path.abspath(os.path.dirname(__file__)), '../.cache')):
+                self.fast_startup = True
+            else:
+                # spotify needs to prompt for authentication, which can't happen while listening to the keyboard
+                logger.warning("No spotify token cached yet, fast startup disabled for this run.")
+        if os.getenv('MOOD_PLAN_MODE') is not None and os.getenv('MOOD_PLAN_MODE').lower() == "true":
+            logger.info("Enabling mood plan mode...")
+            self.mood_plan_mode = True
+        if os.getenv('LLM_STREAMING') is not None and os.getenv('LLM_STREAMING').lower() == "true":
+            logger.info("Enabling llm streaming...")
+            self.llm_streaming = True
+        if os.getenv('METRICS_TRACE_PATH'):
+            metrics.start_trace(os.getenv('METRICS_TRACE_PATH'))
+        if os.getenv('METRICS_PORT'):
+            metrics.start_server(int(os.getenv('METRICS_PORT')))
+        if not self.fast_startup:
+            self.setup_components()
         logger.info("Running...")
 
+    # heavy imports and clients, warmed in the background after the keyboard listener starts in fast startup mode
+    def setup_components(self):
+        try:
+            with startup_profiler.span('import langchain_openai'):
+                from langchain_openai import ChatOpenAI
+            with startup_profiler.span('import mood'):
+                from mood import Mood
+            with startup_profiler.span('import music'):
+                from music import Music
+            with startup_profiler.span('init ChatOpenAI'):
+                self.llm = self.create_llm(ChatOpenAI)
+            with startup_profiler.span('init Mood'):
+                self.mood = Mood(self.llm)
+            self.mood.schedule_mood_changer_refreshes(self.scheduler, self.is_quiet_hours_now)
+            with startup_profiler.span('init Music'):
+                self.music = Music(self.llm)
+            self.history = self.music.history
+            self.mood_pipeline = MoodPipeline(self.mood, self.music, self.mood_plan_mode, self.llm_streaming)
+            if os.getenv('MOOD_PREFETCH') is not None and os.getenv('MOOD_PREFETCH').lower() == "true":
+                logger.info("Enabling mood prefetch...")
+                from mood_prefetcher import MoodPrefetcher
+                self.mood_prefetch_lead_minutes = float(os.getenv('MOOD_PREFETCH_LEAD_MINUTES')) if os.getenv('MOOD_PREFETCH_LEAD_MINUTES') is not None else self.MOOD_PREFETCH_LEAD_MINUTES
+                self.mood_prefetcher = MoodPrefetcher(self.mood_pipeline, self.get_mood_prefetch_max_age_seconds())
+            if os.getenv('RASPBERRY_PI_SCREEN') is not None and os.getenv('RASPBERRY_PI_SCREEN').lower() == "true" and os.name != 'nt':
+                logger.info("Setting up screen...")
+                with startup_profiler.span('import epaper_display'):
+                    from epaper_display import EPaperDisplay
+                with startup_profiler.span('init EPaperDisplay'):
+                    self.screen = EPaperDisplay(self.llm, self.version_str)
+                self.screen_enabled = True
+                Thread(target=self.display_render_worker, args=(), name='display_render_worker', daemon=True).start()
+        except Exception as e:
+            logger.error("Failed to set up")
+            logger.error(e)
+            if not self.fast_startup:
+                raise e
+        finally:
+            startup_profiler.mark('components ready')
+            self.components_ready.set()
+            if self.fast_startup:
+                self.log_startup_report()
+
+    def create_llm(self, llm_class):
+        return llm_class(
+            model=self.MODEL,
+            temperature=0.9,
+            max_tokens=2000,
+            openai_api_key=os.getenv('OPENAI_API_KEY')
+        )
+
+    # a prepared mood is only as fresh as the mood changer data it was built from
+    def get_mood_prefetch_max_age_seconds(self):
+        if os.getenv('MOOD_PREFETCH_MAX_AGE_MINUTES'):
+            return 60.0 * float(os.getenv('MOOD_PREFETCH_MAX_AGE_MINUTES'))
+        return float(min([mood_changer.CACHE_TTL_SECONDS for mood_changer in self.mood.mood_changers], default=60 * 60))
+
+    def log_startup_report(self):
+        print_report = os.getenv('STARTUP_REPORT') is not None and os.getenv('STARTUP_REPORT').lower() == "true"
+        for line in startup_profiler.report():
+            logger.info(line)
+            if print_report:
+                print(line)
+
     def load_key_configuration(self):
         self.CHANGE_MOOD_KEY = os.getenv('CHANGE_MOOD_KEY').strip() if os.getenv('CHANGE_MOOD_KEY') is not None else self.CHANGE_MOOD_KEY
         self.PLAY_PAUSE_KEY = os.getenv('PLAY_PAUSE_KEY').strip() if os.getenv('PLAY_PAUSE_KEY') is not None else self.PLAY_PAUSE_KEY
@@ -81,8 +182,12 @@ class Controller:
     def start(self):
         keyboard_listener = Thread(target=listen_keyboard, args=(self.on_keypress,))
         keyboard_listener.start()
+        startup_profiler.mark('keyboard listener started')
+        if self.fast_startup:
+            Thread(target=self.setup_components, args=(), name='setup_components', daemon=True).start()
+        else:
+            self.log_startup_report()
         self.start_mood_timer()
-        self.display_refresh_timer()
         keyboard_listener.join()
 
     def setup_logger(self):
@@ -110,8 +215,14 @@ class Controller:
     def cleanup_and_exit(self):
         if self.music is not None:
             self.music.pause()
+            if self.music.playlist_index is not None:
+                # lookups only note what was reused in memory, written out here so it carries over restarts
+                self.music.playlist_index.flush()
         if self.screen_enabled and self.screen is not None:
             self.screen.init_and_refresh()
+            self.screen.icon_store.flush()
+        self.scheduler.stop()
+        self.dispatcher.shutdown()
         stop_listening()
 
     def on_keypress(self, key):
@@ -121,63 +232,137 @@ class Controller:
             self.cleanup_and_exit()
         elif key == self.CHANGE_MOOD_KEY:
             logger.info("Determining new mood...")
-            Thread(target=self.determine_mood_and_play, args=(), name='determine_mood_and_play').start()
+            self.request_new_mood()
+            self.restart_mood_timer()
         elif key == self.PLAY_PAUSE_KEY:
             logger.info("Play/pause music...")
             if self.music is not None:
-                Thread(target=self.music.play_pause, args=(), name='play_pause').start()
+                self.dispatcher.dispatch('play_pause', self.play_pause)
         elif key == self.INFO_KEY:
             logger.info("Displaying info...")
-            Thread(target=self.get_reasoning_info, args=(), name='get_reasoning_info').start()
+            self.dispatcher.dispatch('info', self.get_reasoning_info)
         elif key == self.NEXT_KEY:
             logger.info("Next track...")
             if self.music is not None:
-                Thread(target=self.next_track, args=(), name='next_track').start()
+                self.dispatcher.dispatch('next_track', self.next_track)
         elif key == self.PREV_KEY:
             logger.info("Previous track...")
             if self.music is not None:
-                Thread(target=self.prev_track, args=(), name='prev_track').start()
+                self.dispatcher.dispatch('prev_track', self.prev_track)
+
+    # a mood change that is already waiting covers any newer request, from a key press or the timer
+    def request_new_mood(self):
+        self.dispatcher.dispatch('new_mood', lambda count: self.determine_mood_and_play())
 
+    # newer requests cancel this one at the next stage boundary, the mood lock only guards the final commit
     def determine_mood_and_play(self):
+        started_at = time.monotonic()
+        self.components_ready.wait()
+        if self.mood is None or self.music is None:
+            return
+        token = self.start_mood_request()
+        self.is_quiet_hours = self.check_if_quiet_hours()
+        if self.quiet_hours_enabled and self.is_quiet_hours:
+            self.handle_quiet_hours()
+            return
+        try:
+            candidate = self.mood_prefetcher.take() if self.mood_prefetcher is not None else None
+            if candidate is not None:
+                logger.info("Using prepared mood {0}".format(candidate.mood))
+            else:
+                candidate = self.mood_pipeline.build(token)
+            self.commit_mood(candidate, token, started_at)
+            print("MOOD: {0} | PLAYLIST: {1}".format(self.mood.current_mood, self.music.playlist['name'] if self.music.playlist is not None else "None"))
+        except MoodPipelineCancelled as e:
+            logger.info("Mood change superseded by a newer request ({0})".format(e))
+            return
+        except Exception as e:
+            logger.error("Failed to determine new mood")
+            logger.error(e)
+        self.notify_display_changed()
+
+    def start_mood_request(self):
+        token = CancellationToken()
+        with self.mood_request_lock:
+            if self.mood_request_token is not None:
+                self.mood_request_token.cancel()
+            self.mood_request_token = token
+        return token
+
+    # the mood lock only covers swapping the state, spotify is called after it is released
+    def commit_mood(self, candidate, token, started_at=None):
         logger.debug("Aquiring mood lock...")
         with self.mood_lock:
             logger.debug("Mood lock aquired.")
-            self.is_quiet_hours = self.check_if_quiet_hours()
-            if self.mood is not None and self.music is not None:
-                if self.quiet_hours_enabled and self.is_quiet_hours:
-                    if not self.quiet_hours_handled:
-                        logger.info("Quiet hours, pausing music and sleeping...")
-                        self.music.pause()
-                        self.mood.current_mood = "SLEEPING"
-                        self.music.playlist = None
-                        self.quiet_hours_handled = True
-                else:
-                    self.quiet_hours_handled = False
-                    try:
-                        self.music.start_playlist_based_on_mood(self.mood.determine_mood())
-                        print("MOOD: {0} | PLAYLIST: {1}".format(self.mood.current_mood, self.music.playlist['name'] if self.music.playlist is not None else "None"))
-                    except Exception as e:
-                        logger.error("Failed to determine new mood")
-                        logger.error(e)
-            if self.screen_enabled and self.screen is not None:
-                self.refresh_rpi_display()
+            token.check('commit')
+            self.quiet_hours_handled = False
+            self.mood.set_mood(candidate.mood, candidate.mood_reason, candidate.mood_reason_future)
+            self.music.set_playlist(candidate.playlist, candidate.search_query, candidate.search_query_reason, candidate.search_query_reason_future)
             logger.debug("Releasing mood lock...")
+        # a newer request or quiet hours starting since the commit own the playback now
+        token.check('playback')
+        self.music.play_playlist()
+        self.record_history(candidate, time.monotonic() - started_at if started_at is not None else 0.0)
+        self.schedule_track_poll()
+        # redraw the info screen once the reasoning finishes streaming
+        for future in self.get_reasoning_futures():
+            future.add_done_callback(lambda f: self.notify_display_changed())
+
+    def record_history(self, candidate, seconds_to_music):
+        if self.history is None:
+            return
+        if candidate.mood_reason_future is not None:
+            # streamed reasoning is written once it has finished
+            candidate.mood_reason_future.add_done_callback(lambda f: self.history.record_mood(candidate.mood, f.result() if f.exception() is None else ''))
+        else:
+            self.history.record_mood(candidate.mood, candidate.mood_reason)
+        if candidate.playlist is not None:
+            self.history.record_playlist(candidate.playlist, seconds_to_music)
+
+    def handle_quiet_hours(self):
+        if self.mood_prefetcher is not None:
+            self.mood_prefetcher.invalidate()
+        with self.mood_lock:
+            if not self.quiet_hours_handled:
+                logger.info("Quiet hours, pausing music and sleeping...")
+                self.music.pause()
+                self.mood.current_mood = "SLEEPING"
+                self.music.playlist = None
+                self.quiet_hours_handled = True
+        self.notify_display_changed()
+
+    def get_reasoning_futures(self):
+        return [future for future in [self.mood.mood_reason_future, self.music.search_query_reason_future] if future is not None]
 
-    def get_reasoning_info(self):
-        if self.mood is not None and self.music is not None:
+    def get_reasoning_info(self, count=1):
+        # pressing info twice toggles the info screen back, so only an odd number of presses does anything
+        if self.mood is not None and self.music is not None and count % 2 == 1:
+            if self.llm_streaming:
+                wait(self.get_reasoning_futures(), timeout=self.REASONING_WAIT_SECONDS)
             print("Mood Reasoning: {0}".format(self.mood.current_mood_reason))
             print("Playlist Reasoning: {0}".format(self.music.search_query_reason))
             self.toggle_info_display()
 
-    def next_track(self):
-        self.music.next_track()
-        if self.screen_enabled:
-            self.refresh_rpi_display()
+    def play_pause(self, count=1):
+        if count % 2 == 0:
+            return
+        self.music.play_pause()
+        # track end prediction changes when playback pauses or resumes
+        self.notify_display_changed()
+
+    def next_track(self, count=1):
+        self.music.next_track(count)
+        self.notify_display_changed()
+        self.schedule_track_poll()
 
-    def prev_track(self):
-        self.music.previous_track()
+    def prev_track(self, count=1):
+        self.music.previous_track(count)
+        self.notify_display_changed()
+        self.schedule_track_poll()
+
+    def notify_display_changed(self):
         if self.screen_enabled:
-            self.refresh_rpi_display()
+            self.display_changed.set()
 
     def refresh_rpi_display(self):
         if self.screen_enabled and self.screen is not None and self.mood is not None and self.music is not None:
@@ -202,31 +387,98 @@ class Controller:
                     logger.error("Failed to toggle info screen")
                     logger.error(e)
             logger.debug("Releasing display lock.")
+            self.notify_display_changed()
+
+    # single long lived thread that redraws the display when state changes or the current track should end
+    def display_render_worker(self):
+        self.display_changed.set() # draw the first frame right away
+        while True:
+            if self.display_changed.wait(timeout=self.get_seconds_until_track_change()):
+                time.sleep(self.DISPLAY_COALESCE_SECONDS)
+                self.display_changed.clear()
+            self.refresh_rpi_display()
+
+    def get_seconds_until_track_change(self, music=None):
+        music = music if music is not None else self.music
+        try:
+            playback = music.playback.get() if music is not None else None
+        except Exception as e:
+            logger.warning("Could not get playback state to predict next track due to {0}".format(e))
+            return self.DISPLAY_MAX_IDLE_SECONDS
+        if playback is None or not playback.get('is_playing') or playback.get('item') is None or playback.get('progress_ms') is None:
+            return self.DISPLAY_MAX_IDLE_SECONDS
+        remaining_seconds = (playback['item']['duration_ms'] - playback['progress_ms']) / 1000.0
+        return min(max(remaining_seconds, 0.0) + self.TRACK_CHANGE_MARGIN_SECONDS, self.DISPLAY_MAX_IDLE_SECONDS)
+
+    # reading the playback notes a new track in the history, so the history polls whenever a track should have changed
+    # without this tracks would only be recorded when the screen or a key press happens to read the playback
+    def schedule_track_poll(self, delay_seconds=TRACK_SETTLE_SECONDS, music=None, name='track'):
+        if self.history is not None:
+            self.scheduler.schedule_in(delay_seconds, name, lambda due: self.poll_track(music, name))
 
-    def display_refresh_timer(self):
-        # checks if need to refresh the display periodically
-        disp_refresh_daemon = Timer(5.0, self.display_refresh_timer)
-        disp_refresh_daemon.daemon = True
-        disp_refresh_daemon.start()
-        self.refresh_rpi_display()
+    def poll_track(self, music, name):
+        self.schedule_track_poll(self.get_seconds_until_track_change(music), music, name)
 
     def start_mood_timer(self):
         # default to every hour if environment not set
-        # during quiet hours, want to check every minute, not the default
-        durationMinutes = int(os.getenv('NEW_MOOD_TIMER_MINUTES')) if os.getenv('NEW_MOOD_TIMER_MINUTES') is not None else 60.0
-        if self.check_if_quiet_hours():
-            durationMinutes = 1.0
-        logger.info("Starting a new mood timer for {0} minutes from now...".format(durationMinutes))
-        timer_daemon = Timer(60.0 * (float(durationMinutes)), self.start_mood_timer)
-        timer_daemon.daemon = True
-        timer_daemon.start()
-        self.determine_mood_and_play()
+        self.mood_timer_seconds = 60.0 * float(os.getenv('NEW_MOOD_TIMER_MINUTES')) if os.getenv('NEW_MOOD_TIMER_MINUTES') is not None else 60.0 * 60.0
+        self.scheduler.start()
+        self.scheduler.schedule_in(0.0, 'mood', self.on_mood_timer)
+
+    # runs on the scheduler thread, so it only hands the mood change off and works out the next wake up
+    def on_mood_timer(self, due):
+        self.request_new_mood()
+        self.schedule_next_mood(self.get_next_mood_due(due))
+
+    # a mood picked by hand counts as a tick, so the timer does not change it again shortly after
+    def restart_mood_timer(self):
+        if self.scheduler.get_due('mood') is None:
+            return
+        self.scheduler.cancel('mood_prefetch')
+        self.schedule_next_mood(self.get_next_mood_due(time.monotonic()))
+
+    def schedule_next_mood(self, next_due):
+        logger.info("Next mood timer in {0:.1f} minutes...".format((next_due - time.monotonic()) / 60.0))
+        self.scheduler.schedule_at(next_due, 'mood', self.on_mood_timer)
+        lead_seconds = 60.0 * self.mood_prefetch_lead_minutes
+        if self.mood_prefetcher is not None and next_due - lead_seconds > time.monotonic():
+            # the next mood is only built this lead time before the timer needs it
+            self.scheduler.schedule_at(next_due - lead_seconds, 'mood_prefetch', lambda prefetch_due: self.prefetch_next_mood(lead_seconds))
+
+    def get_next_mood_due(self, due):
+        if self.quiet_hours_enabled and self.check_if_quiet_hours():
+            # nothing changes until quiet hours end, sleep straight through them
+            return time.monotonic() + self.get_seconds_until(self.quiet_hours_end) + self.QUIET_HOURS_MARGIN_SECONDS
+        # next tick counts from when this one was due so time spent running it does not add up
+        next_due = due + self.mood_timer_seconds
+        if self.quiet_hours_enabled and self.quiet_hours_start is not None:
+            # wake up when quiet hours start to pause the music
+            next_due = min(next_due, time.monotonic() + self.get_seconds_until(self.quiet_hours_start) + self.QUIET_HOURS_MARGIN_SECONDS)
+        return next_due
+
+    def prefetch_next_mood(self, within_seconds=0.0):
+        if self.mood_prefetcher is not None and not (self.quiet_hours_enabled and self.check_if_quiet_hours()):
+            self.mood_prefetcher.ensure_candidate(within_seconds)
+
+    def is_quiet_hours_now(self):
+        return self.quiet_hours_enabled and self.check_if_quiet_hours()
 
     def check_if_quiet_hours(self):
         time_now = datetime.now().time()
         if self.quiet_hours_start is None or self.quiet_hours_end is None:
             return False
-        return time_now < self.quiet_hours_end or time_now > self.quiet_hours_start
+        if self.quiet_hours_start <= self.quiet_hours_end:
+            return self.quiet_hours_start <= time_now < self.quiet_hours_end
+        # window crosses midnight
+        return time_now >= self.quiet_hours_start or time_now < self.quiet_hours_end
+
+    # seconds until the wall clock next reads the given time of day
+    def get_seconds_until(self, time_of_day):
+        now = datetime.now()
+        target = datetime.combine(now.date(), time_of_day)
+        if target <= now:
+            target += timedelta(days=1)
+        return (target - now).total_seconds()
     
     def parse_quiet_hours(self):
         try:
@@ -12,7 +12,13 @@ from PIL import Image,ImageDraw,ImageFont
 import logging
 import textwrap
 import urllib.request
+from collections import OrderedDict
 from pathlib import Path
+from mood_icon_store import MoodIconStore
+from refresh_scheduler import RefreshScheduler
+from framebuffer import FrameBufferPacker
+from llm_memo import memoize_chain
+from metrics import metrics
 LIB_DIR = Path(os.path.dirname(os.path.realpath(__file__))).resolve().parent / "resources"/ "lib"
 sys.path.append(str(LIB_DIR))
 from waveshare_epd import epd2in9_V2
@@ -37,16 +43,14 @@ class EPaperDisplay:
     NEW_MOOD_IMG_PATH = IMG_DIR / "icons8-reload-turn-arrow-function-to-spin-and-restart-24.png"
     INFO_IMG_PATH = IMG_DIR / "icons8-info-24.png"
 
-    FONT_8 = ImageFont.truetype(str(FONT_PATH), 8)
-    FONT_10 = ImageFont.truetype(str(FONT_PATH), 10)
-    FONT_12 = ImageFont.truetype(str(FONT_PATH), 12)
-    FONT_18 = ImageFont.truetype(str(FONT_PATH), 18)
-    FONT_14 = ImageFont.truetype(str(FONT_PATH), 14)
+    # loaded on first use, see get_font
+    fonts = {}
 
     IMG_SIZE = 24
 
     MOOD_ICON_DISPLAY_SIZE_PX = 90
     MOOD_ICON_SIZE_PX = 256 # LLM can only generate to so small a size
+    MOOD_ICON_CACHE_SIZE = 16 # mood icons kept in memory already resized and dithered
 
     MOOD_ICON_PROMPT = """
     Generate a prompt of less than 20 words to create an image based on the following mood {mood}.
@@ -75,12 +79,17 @@ class EPaperDisplay:
             input_variables=self.MOOD_ICON_PROMPT_VARS,
             template=self.MOOD_ICON_PROMPT
         )
-        self.mood_chain = LLMChain(llm=self.llm, prompt=self.mood_prompt_template)
+        self.mood_chain = memoize_chain(LLMChain(llm=self.llm, prompt=self.mood_prompt_template), 'icon_prompt', lambda text: len(text.strip()) > 0)
         logger.info("Setting up llm for image generation...")
         self.image_llm = DallEAPIWrapper(
             model="dall-e-2", # dall-e-3 only supports image size 1024x1024
             size='{0}x{0}'.format(self.MOOD_ICON_SIZE_PX)
         )
+        self.icon_store = MoodIconStore(
+            self.MOOD_IMG_DIR,
+            max_generated_icons=int(os.getenv('MOOD_ICON_CACHE_MAX')) if os.getenv('MOOD_ICON_CACHE_MAX') is not None else MoodIconStore.MAX_GENERATED_ICONS,
+            match_cutoff=float(os.getenv('MOOD_ICON_MATCH_CUTOFF')) if os.getenv('MOOD_ICON_MATCH_CUTOFF') is not None else MoodIconStore.MATCH_CUTOFF
+        )
         logger.info("Loading icons...")
         self.PREV_IMG = self.load_image(str(self.PREV_IMG_PATH))
         self.NEXT_IMG = self.load_image(str(self.NEXT_IMG_PATH))
@@ -89,9 +98,22 @@ class EPaperDisplay:
         self.INFO_IMG = self.load_image(str(self.INFO_IMG_PATH))
         logger.info("Setting up display...")
         self.epd = epd2in9_V2.EPD()
+        self.mood_icons = OrderedDict()
+        self.static_layer = self.build_static_layer()
+        self.framebuffer = FrameBufferPacker(self.epd.width, self.epd.height)
+        self.refresh_scheduler = RefreshScheduler(
+            full_refresh_every=int(os.getenv('EPAPER_FULL_REFRESH_EVERY')) if os.getenv('EPAPER_FULL_REFRESH_EVERY') is not None else RefreshScheduler.FULL_REFRESH_EVERY,
+            partial_max_area_fraction=float(os.getenv('EPAPER_PARTIAL_MAX_AREA')) if os.getenv('EPAPER_PARTIAL_MAX_AREA') is not None else RefreshScheduler.PARTIAL_MAX_AREA_FRACTION,
+            partial_supported=hasattr(self.epd, 'display_Partial') and hasattr(self.epd, 'display_Base')
+        )
         self.init_and_refresh()
         logger.info("Display initialized.")
 
+    def get_font(self, size):
+        if size not in self.fonts:
+            self.fonts[size] = ImageFont.truetype(str(self.FONT_PATH), size)
+        return self.fonts[size]
+
     # ensures image works on epaper (converts transparent -> white)
     def load_image(self, image_path):
         raw_image = Image.open(image_path).convert("RGBA")
@@ -110,13 +132,12 @@ class EPaperDisplay:
         if not self.should_refresh(mood_text, playlist_text, song_name_text, artist_name_text, mood_info_text, playlist_info_text, self.is_info_screen):
             return
         logger.info("State has changed, refreshing display...")
-        Himage = Image.new('1', (self.epd.width, self.epd.height), 255)
+        Himage = self.static_layer.copy()
         draw = ImageDraw.Draw(Himage)
-        draw.text((85, self.epd.height-15), 'BeBa v{0}'.format(self.version_str), font = self.FONT_10, fill = 0)
-        draw.text((35, 115), '{0}'.format(mood_text.upper()), font = self.FONT_14, fill = 0)
+        draw.text((35, 115), '{0}'.format(mood_text.upper()), font = self.get_font(14), fill = 0)
         if not self.is_info_screen:
             max_text_length = 12
-            text_font = self.FONT_12
+            text_font = self.get_font(12)
             spacing = 15
             text_lines = textwrap.fill(playlist_text, max_text_length).split('\n')
             text_lines.extend('\n')
@@ -124,21 +145,39 @@ class EPaperDisplay:
             text_lines.extend(textwrap.fill(artist_name_text, max_text_length).split('\n'))
         else:
             max_text_length = 24
-            text_font = self.FONT_8
+            text_font = self.get_font(8)
             spacing = 10
             text_lines = textwrap.fill(mood_info_text, max_text_length).split('\n')
             #text_lines.extend(textwrap.fill(playlist_info_text, max_text_length).split('\n'))
             
         self.render_text(draw, text_lines, 35, 140, spacing, text_font)
-        self.render_button_info(draw, Himage)
         if self.last_render['mood'] != mood_text:
             self.render_mood(Himage, self.determine_mood_image(mood_text))
         else:
             self.render_mood(Himage, self.current_mood_icon.lower())
-        Himage = Himage.transpose(method=Image.ROTATE_180)
-        self.epd.display(self.epd.getbuffer(Himage))
+        # mood changes redraw the icon so always get a full refresh
+        self.refresh_display(Himage, force_full=self.last_render['mood'] != mood_text)
         self.save_last_render(mood_text, playlist_text, song_name_text, artist_name_text, mood_info_text, playlist_info_text, self.is_info_screen)
 
+    def refresh_display(self, Himage, force_full=False):
+        refresh = self.refresh_scheduler.plan(Himage, force_full)
+        logger.debug("Refreshing display with a {0} refresh".format(refresh))
+        if refresh != RefreshScheduler.NONE:
+            # panel is mounted upside down, the rotation happens while packing the buffer
+            buffer = self.framebuffer.pack(Himage, rotate_180=True)
+        if refresh == RefreshScheduler.FULL:
+            with metrics.span('epd.display_full'):
+                if self.refresh_scheduler.partial_supported:
+                    # panel has to leave partial mode, display_Base also sets the base image for later partial refreshes
+                    self.epd.init()
+                    self.epd.display_Base(buffer)
+                else:
+                    self.epd.display(buffer)
+        elif refresh == RefreshScheduler.PARTIAL:
+            with metrics.span('epd.display_partial'):
+                self.epd.display_Partial(buffer)
+        self.refresh_scheduler.commit(Himage, refresh)
+
     def should_refresh(self, mood, playlist, song, artist, mood_info, playlist_info, is_info_screen):
         return any([self.last_render['mood'] != mood, 
                 self.last_render['playlist'] != playlist, 
@@ -158,6 +197,14 @@ class EPaperDisplay:
         self.last_render['is_info_screen'] = is_info_screen
         logger.debug(self.last_render)
 
+    # everything that never changes between renders (buttons, divider, version) is drawn once
+    def build_static_layer(self):
+        static_layer = Image.new('1', (self.epd.width, self.epd.height), 255)
+        draw = ImageDraw.Draw(static_layer)
+        draw.text((85, self.epd.height-15), 'BeBa v{0}'.format(self.version_str), font = self.get_font(10), fill = 0)
+        self.render_button_info(draw, static_layer)
+        return static_layer
+
     def render_text(self, draw, lines, start_x, start_y, y_spacing, font_size):
         for i, line in enumerate(lines):
             draw.text((start_x, start_y + (i*y_spacing)), '{0}'.format(line), font = font_size, fill = 0)
@@ -172,35 +219,57 @@ class EPaperDisplay:
         Himage.paste(self.NEXT_IMG, (start_x, 194))
         Himage.paste(self.INFO_IMG, (start_x, 253))
 
-    # generates mood image using DALL-E
+    # reuses an existing icon for the mood (or a close synonym), otherwise generates one using DALL-E
     def determine_mood_image(self, mood_text, retry=True):
+        existing_icon = self.icon_store.lookup(mood_text)
+        metrics.cache('mood_icon', existing_icon is not None)
+        if existing_icon is not None:
+            self.current_mood_icon = existing_icon
+            self.current_mood_icon_reason = "Reused existing icon {0}".format(existing_icon)
+            return self.current_mood_icon.lower()
         try:
             image_name = mood_text.replace(' ', '').lower()
-            mood_icon_response = self.mood_chain.invoke({'mood' : mood_text})
+            with metrics.span('llm.icon_prompt'):
+                mood_icon_response = self.mood_chain.invoke({'mood' : mood_text})
             logger.debug("LLM response: {0}".format(mood_icon_response))
-            image_url = self.image_llm.run(mood_icon_response['text'])
+            with metrics.span('dalle.generate'):
+                image_url = self.image_llm.run(mood_icon_response['text'])
             logger.debug("Image URL {0}".format(image_url))
             # Note - this overwrites existing images of same mood, long term maybe we do something else (save all images?)
-            urllib.request.urlretrieve(image_url, self.MOOD_IMG_DIR / "{0}.png".format(image_name))
+            with metrics.span('dalle.download'):
+                urllib.request.urlretrieve(image_url, self.MOOD_IMG_DIR / "{0}.png".format(image_name))
+            self.icon_store.add(mood_text, image_name)
+            self.mood_icons.pop(image_name, None)
 
             self.current_mood_icon = image_name
             self.current_mood_icon_reason = mood_icon_response
         except Exception as e:
             if retry:
+                metrics.retry('dalle.generate')
                 return self.determine_mood_image(mood_text, retry=False)
             else:
                 raise e
         return self.current_mood_icon.lower()
 
     def render_mood(self, Himage, mood):
-        self.MOOD_IMG_PATH = self.MOOD_IMG_DIR / "{0}.png".format(mood)
-        self.MOOD_IMG = self.load_image(str(self.MOOD_IMG_PATH))
-        self.MOOD_IMG = self.resize_image(self.MOOD_IMG, self.MOOD_ICON_DISPLAY_SIZE_PX)
-        Himage.paste(self.MOOD_IMG, (35, 20))
+        Himage.paste(self.get_mood_icon(mood), (35, 20))
+
+    # mood icons are cached resized and dithered to the panel's 1-bit format
+    def get_mood_icon(self, mood):
+        if mood in self.mood_icons:
+            self.mood_icons.move_to_end(mood)
+            return self.mood_icons[mood]
+        mood_img_path = self.MOOD_IMG_DIR / "{0}.png".format(mood)
+        mood_icon = self.resize_image(self.load_image(str(mood_img_path)), self.MOOD_ICON_DISPLAY_SIZE_PX).convert('1')
+        self.mood_icons[mood] = mood_icon
+        while len(self.mood_icons) > self.MOOD_ICON_CACHE_SIZE:
+            self.mood_icons.popitem(last=False)
+        return mood_icon
 
     def init_and_refresh(self):
         self.epd.init()
         self.epd.Clear(0xFF)
+        self.refresh_scheduler.reset()
 
     def toggle_info_screen(self):
         self.is_info_screen = not self.is_info_screen
@@ -0,0 +1,34 @@
+# Copyright Michael Kukar 2023
+
+from PIL import Image
+
+# packs 1-bit frames into the e-paper byte layout (8 pixels per byte, most significant bit first, 1 is white)
+# this is the same layout as epd.getbuffer() but done on the whole frame at once into a reused buffer
+class FrameBufferPacker:
+
+    # reverses the bits of every byte, reversing the bytes and their bits rotates a packed frame by 180 degrees
+    BIT_REVERSE = bytes([int('{0:08b}'.format(i)[::-1], 2) for i in range(256)])
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.buffer = bytearray((width + 7) // 8 * height)
+
+    def pack(self, image, rotate_180=False):
+        if image.size == (self.height, self.width):
+            # landscape frame, same handling as epd.getbuffer()
+            image = image.rotate(90, expand=True)
+        if image.size != (self.width, self.height):
+            raise ValueError("Frame must be {0}x{1}, got {2}x{3}".format(self.width, self.height, image.size[0], image.size[1]))
+        if image.mode != '1':
+            image = image.convert('1')
+        if rotate_180 and self.width % 8 != 0:
+            # rows are padded to whole bytes so the rotation can not be folded into packing
+            image = image.transpose(method=Image.ROTATE_180)
+            rotate_180 = False
+        raw = image.tobytes('raw', '1')
+        if rotate_180:
+            self.buffer[:] = raw[::-1].translate(self.BIT_REVERSE)
+        else:
+            self.buffer[:] = raw
+        return self.buffer
@@ -0,0 +1,164 @@
+# Copyright Michael Kukar 2023
+
+import json
+import logging
+import os
+import struct
+import time
+from collections import deque, namedtuple
+from threading import Lock
+
+from metrics import metrics
+
+logger = logging.getLogger('beba')
+
+HistoryEntry = namedtuple('HistoryEntry', ['time', 'kind', 'text', 'detail', 'value'])
+
+# append-only log of every mood, playlist and track, kept apart from beba.log so it survives log rotation
+# records are fixed size (time, kind, text id, detail id, value) so a time range is found by binary search
+# the text they refer to is interned in a <path>.strings file, one json string per line
+class History:
+
+    MOOD = 1 # text is the mood, detail its reasoning
+    PLAYLIST = 2 # text is the playlist uri, detail its name, value the seconds from the mood request to music
+    TRACK = 3 # text is the track name, detail the artist
+
+    RECORD = struct.Struct('<dBIIf')
+    RECENT_ENTRIES = 500 # newest entries kept in memory, queries that fit in them never touch the disk
+    DAY_SECONDS = 24 * 60 * 60
+
+    def __init__(self, path, recent_entries=RECENT_ENTRIES):
+        self.path = path
+        self.strings_path = "{0}.strings".format(path)
+        self.strings = [] # id -> text
+        self.string_ids = {} # text -> id
+        self.recent = deque(maxlen=recent_entries)
+        self.count = 0
+        self.lock = Lock()
+        self.load()
+        self.records_file = open(self.path, 'ab')
+        self.strings_file = open(self.strings_path, 'a', encoding='utf-8')
+
+    # anything after the last complete line or record was cut short by a power cut and is dropped
+    def load(self):
+        if os.path.exists(self.strings_path):
+            with open(self.strings_path, 'rb') as f:
+                data = f.read()
+            valid_length = 0
+            for line in data.split(b'\n')[:-1]: # the piece after the last newline is never complete
+                try:
+                    text = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                self.intern_loaded(text)
+                valid_length += len(line) + 1
+            if valid_length != len(data):
+                logger.warning("Dropping damaged end of history strings file {0}".format(self.strings_path))
+                os.truncate(self.strings_path, valid_length)
+        if os.path.exists(self.path):
+            size = os.path.getsize(self.path)
+            self.count = size // self.RECORD.size
+            # records are written after their strings, a record pointing past the strings lost its text
+            with open(self.path, 'rb') as f:
+                while self.count > 0:
+                    f.seek((self.count - 1) * self.RECORD.size)
+                    _, _, text_id, detail_id, _ = self.RECORD.unpack(f.read(self.RECORD.size))
+                    if text_id < len(self.strings) and detail_id < len(self.strings):
+                        break
+                    self.count -= 1
+            if size != self.count * self.RECORD.size:
+                logger.warning("Dropping damaged end of history file {0}".format(self.path))
+                os.truncate(self.path, self.count * self.RECORD.size)
+            recent_count = min(self.count, self.recent.maxlen)
+            self.recent.extend(self.read_entries(self.count - recent_count))
+        logger.debug("Loaded {0} history entries from {1}".format(self.count, self.path))
+
+    def intern_loaded(self, text):
+        self.string_ids[text] = len(self.strings)
+        self.strings.append(text)
+
+    def get_string_id(self, text):
+        text = text or ''
+        if text not in self.string_ids:
+            self.strings_file.write(json.dumps(text) + '\n')
+            self.strings_file.flush()
+            self.intern_loaded(text)
+        return self.string_ids[text]
+
+    def append(self, kind, text, detail='', value=0.0):
+        try:
+            with self.lock:
+                entry = HistoryEntry(time.time(), kind, text or '', detail or '', float(value))
+                # strings are written first so a record never refers to text that is not on disk
+                record = self.RECORD.pack(entry.time, kind, self.get_string_id(entry.text), self.get_string_id(entry.detail), entry.value)
+                self.records_file.write(record)
+                self.records_file.flush()
+                self.count += 1
+                self.recent.append(entry)
+        except Exception as e:
+            logger.warning("Could not write history due to {0}".format(e))
+
+    def record_mood(self, mood, mood_reason):
+        self.append(self.MOOD, mood, mood_reason)
+
+    def record_playlist(self, playlist, seconds_to_music=0.0):
+        self.append(self.PLAYLIST, playlist['uri'], playlist.get('name'), seconds_to_music)
+
+    def record_track(self, track):
+        self.append(self.TRACK, track.get('name'), track['artists'][0]['name'] if track.get('artists') else '')
+
+    def read_entries(self, start_index):
+        with open(self.path, 'rb') as f:
+            f.seek(start_index * self.RECORD.size)
+            data = f.read((self.count - start_index) * self.RECORD.size)
+        return [HistoryEntry(record_time, kind, self.strings[text_id], self.strings[detail_id], value)
+                for record_time, kind, text_id, detail_id, value in self.RECORD.iter_unpack(data)]
+
+    def read_time(self, f, index):
+        f.seek(index * self.RECORD.size)
+        return self.RECORD.unpack(f.read(self.RECORD.size))[0]
+
+    # entries are appended in time order, so the first one in range is found in O(log n) reads
+    def get_entries(self, since_seconds, kind=None):
+        since = time.time() - since_seconds
+        with self.lock:
+            if len(self.recent) == self.count or (len(self.recent) > 0 and self.recent[0].time < since):
+                entries = [entry for entry in self.recent if entry.time >= since]
+            else:
+                with open(self.path, 'rb') as f:
+                    low, high = 0, self.count
+                    while low < high:
+                        middle = (low + high) // 2
+                        if self.read_time(f, middle) < since:
+                            low = middle + 1
+                        else:
+                            high = middle
+                entries = self.read_entries(low)
+        return [entry for entry in entries if kind is None or entry.kind == kind]
+
+    def get_moods(self, since_seconds):
+        return [entry.text for entry in self.get_entries(since_seconds, self.MOOD)]
+
+    # uri -> name of every playlist started within the time
+    def get_played_playlists(self, since_seconds):
+        return dict([(entry.text, entry.detail) for entry in self.get_entries(since_seconds, self.PLAYLIST)])
+
+    def get_mean_time_to_music(self, since_seconds):
+        seconds = [entry.value for entry in self.get_entries(since_seconds, self.PLAYLIST) if entry.value > 0.0]
+        return sum(seconds) / len(seconds) if len(seconds) > 0 else None
+
+
+history = None
+history_lock = Lock()
+
+# one history shared by every component, only created when HISTORY_PATH is set
+def get_history():
+    global history
+    with history_lock:
+        if history is None and os.getenv('HISTORY_PATH'):
+            try:
+                history = History(os.getenv('HISTORY_PATH'), int(os.getenv('HISTORY_RECENT_ENTRIES')) if os.getenv('HISTORY_RECENT_ENTRIES') is not None else History.RECENT_ENTRIES)
+                metrics.gauge('beba_mean_time_to_music_seconds', lambda: history.get_mean_time_to_music(History.DAY_SECONDS))
+            except Exception as e:
+                logger.warning("Could not open history due to {0}, history is disabled".format(e))
+        return history
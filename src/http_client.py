@@ -0,0 +1,104 @@
+# Copyright Michael Kukar 2023
+
+import logging
+import random
+import time
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+
+logger = logging.getLogger('beba')
+
+
+class RateLimitExceeded(requests.RequestException):
+    pass
+
+
+# classic token bucket, holds up to capacity tokens and refills continuously
+class TokenBucket:
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.lock = Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_per_second)
+        self.last_refill = now
+
+    # waits up to timeout seconds for a token, returns False if none became available
+    def acquire(self, timeout=0.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return True
+                wait_seconds = (1.0 - self.tokens) / self.refill_per_second
+            if time.monotonic() + wait_seconds > deadline:
+                return False
+            time.sleep(wait_seconds)
+
+
+# keep-alive session with timeouts, retries with jittered backoff and an optional request budget
+class HttpClient:
+
+    RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+    def __init__(self, name, connect_timeout=3.05, read_timeout=10.0, max_retries=2, backoff_seconds=0.5,
+                 pool_size=4, rate_limiter=None, rate_limit_wait_seconds=5.0):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.rate_limiter = rate_limiter
+        self.rate_limit_wait_seconds = rate_limit_wait_seconds
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, params=None, headers=None):
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None and not self.rate_limiter.acquire(self.rate_limit_wait_seconds):
+                self.record_request(url, 'rate_limited', 0.0, attempt)
+                raise RateLimitExceeded("Request budget for {0} exhausted".format(self.name))
+            start = time.monotonic()
+            response = None
+            try:
+                response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.record_request(url, type(e).__name__, time.monotonic() - start, attempt)
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                self.record_request(url, response.status_code, time.monotonic() - start, attempt)
+                if response.status_code not in self.RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+            time.sleep(self.get_backoff_seconds(attempt, response))
+            attempt += 1
+            metrics.retry("http.{0}".format(self.name))
+
+    def get_backoff_seconds(self, attempt, response=None):
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            # a server asking for a long wait should not stall a mood change, the caller gives up instead
+            return min(float(response.headers['Retry-After']), self.backoff_seconds * (2 ** self.max_retries))
+        # full jitter so retries from several threads do not line up
+        return random.uniform(0, self.backoff_seconds * (2 ** attempt))
+
+    # latency and failures go to the metrics as the http.<name> stage, failed statuses are counted as its errors
+    def record_request(self, url, status, seconds, attempt):
+        metrics.observe("http.{0}".format(self.name), seconds, error=None if isinstance(status, int) and status < 400 else str(status))
+        # only the path is logged, the query string holds api keys
+        url_parts = urlsplit(url)
+        path = "{0}{1}".format(url_parts.netloc, url_parts.path)
+        logger.debug("{0} GET {1} -> {2} in {3:.0f}ms (attempt {4})".format(self.name, path, status, seconds * 1000.0, attempt + 1))
@@ -0,0 +1,176 @@
+# Copyright Michael Kukar 2023
+
+import hashlib
+import logging
+import os
+import random
+import sqlite3
+import time
+from concurrent.futures import Future
+from threading import Lock
+
+from llm_stream import stream_split
+from metrics import metrics
+
+logger = logging.getLogger('beba')
+
+# sqlite backed store of llm responses keyed by a hash of the model and the full prompt
+# each prompt keeps up to variety responses, once that many are stored one of them is reused instead of calling the llm
+class LLMMemoStore:
+
+    TTL_SECONDS = 7 * 24 * 60 * 60
+    MAX_ENTRIES = 1000
+
+    def __init__(self, path, ttl_seconds=TTL_SECONDS, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.lock = Lock()
+        # chains are invoked from several threads, the lock serializes access to the one connection
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS llm_memo (
+                    key TEXT NOT NULL,
+                    chain TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS llm_memo_key ON llm_memo (key)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS llm_memo_last_used ON llm_memo (last_used)")
+
+    @staticmethod
+    def get_key(model, prompt):
+        return hashlib.sha256("{0}\n{1}".format(model, prompt).encode('utf-8')).hexdigest()
+
+    # returns a stored response once variety of them have been collected for the key, otherwise None
+    def get(self, key, variety=1):
+        now = time.time()
+        with self.lock:
+            rows = self.connection.execute("SELECT rowid, response FROM llm_memo WHERE key = ? AND created_at > ?", (key, now - self.ttl_seconds)).fetchall()
+            if len(rows) == 0 or len(rows) < variety:
+                return None
+            rowid, response = random.choice(rows)
+            with self.connection:
+                self.connection.execute("UPDATE llm_memo SET last_used = ? WHERE rowid = ?", (now, rowid))
+        return response
+
+    def add(self, key, chain, response):
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                self.connection.execute("INSERT INTO llm_memo (key, chain, response, created_at, last_used) VALUES (?, ?, ?, ?, ?)", (key, chain, response, now, now))
+                self.evict(now)
+
+    def evict(self, now):
+        self.connection.execute("DELETE FROM llm_memo WHERE created_at <= ?", (now - self.ttl_seconds,))
+        # least recently used responses go first once the store is full
+        self.connection.execute("DELETE FROM llm_memo WHERE rowid IN (SELECT rowid FROM llm_memo ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+
+# drop in for an LLMChain that answers from the memo store when it can
+# only responses that pass validate are stored so a malformed answer is never replayed
+class MemoizedChain:
+
+    # model names the model when the chain's llm wraps it, such as for structured output
+    def __init__(self, chain, name, store, variety=1, validate=None, model=None):
+        self.chain = chain
+        self.name = name
+        self.store = store
+        self.variety = variety
+        self.validate = validate
+        self.model = model if model is not None else getattr(chain.llm, 'model_name', type(chain.llm).__name__)
+
+    def get_key(self, inputs):
+        return self.store.get_key(self.model, self.chain.prompt.format(**inputs))
+
+    def get_memoized(self, key):
+        try:
+            response = self.store.get(key, self.variety)
+            metrics.cache("llm_memo.{0}".format(self.name), response is not None)
+            if response is not None:
+                logger.debug("Reusing memoized {0} response".format(self.name))
+            return response
+        except Exception as e:
+            logger.warning("Could not read llm memo store due to {0}".format(e))
+            return None
+
+    def add_memoized(self, key, response):
+        if self.validate is None or self.validate(response):
+            try:
+                self.store.add(key, self.name, response)
+            except Exception as e:
+                logger.warning("Could not write llm memo store due to {0}".format(e))
+
+    def invoke(self, inputs):
+        key = self.get_key(inputs)
+        response = self.get_memoized(key)
+        if response is not None:
+            return dict(inputs, text=response)
+        llm_response = self.chain.invoke(inputs)
+        self.add_memoized(key, llm_response['text'])
+        return llm_response
+
+    # same as llm_stream.stream_split, sharing the memo with invoke
+    # a memoized response is answered at once, a streamed one is stored once its reasoning has finished streaming in
+    def stream_split(self, runnable, inputs, separator=':'):
+        key = self.get_key(inputs)
+        response = self.get_memoized(key)
+        if response is not None and separator in response:
+            answer, reasoning = response.split(separator, 1)
+            reasoning_future = Future()
+            reasoning_future.set_result(reasoning.replace(separator, '-').strip())
+            return answer.strip(), reasoning_future
+        answer, reasoning_future = stream_split(runnable, inputs, separator)
+        reasoning_future.add_done_callback(lambda future: self.add_memoized(key, "{0}{1} {2}".format(answer, separator, future.result())) if future.exception() is None else None)
+        return answer, reasoning_future
+
+
+# defaults for how many different responses are kept per prompt, a variety of 0 turns memoization off for that chain
+LLM_MEMO_VARIETY = {
+    'mood': 3,
+    'mood_plan': 3,
+    'search_query': 3,
+    'icon_prompt': 1
+}
+
+llm_memo_store = None
+llm_memo_store_lock = Lock()
+
+# one store shared by every chain, only created when LLM_MEMO_PATH is set
+def get_llm_memo_store():
+    global llm_memo_store
+    with llm_memo_store_lock:
+        if llm_memo_store is None and os.getenv('LLM_MEMO_PATH'):
+            ttl_seconds = 60.0 * 60.0 * float(os.getenv('LLM_MEMO_TTL_HOURS')) if os.getenv('LLM_MEMO_TTL_HOURS') is not None else LLMMemoStore.TTL_SECONDS
+            max_entries = int(os.getenv('LLM_MEMO_MAX_ENTRIES')) if os.getenv('LLM_MEMO_MAX_ENTRIES') is not None else LLMMemoStore.MAX_ENTRIES
+            llm_memo_store = LLMMemoStore(os.getenv('LLM_MEMO_PATH'), ttl_seconds, max_entries)
+        return llm_memo_store
+
+# LLM_MEMO_VARIETY is a comma separated list such as mood=3,search_query=5,icon_prompt=1
+def get_llm_memo_variety(name):
+    variety = dict(LLM_MEMO_VARIETY)
+    for setting in (os.getenv('LLM_MEMO_VARIETY') or '').split(','):
+        if '=' in setting:
+            chain, value = setting.split('=', 1)
+            variety[chain.strip()] = int(value)
+    return variety.get(name, 1)
+
+# wraps the chain when memoization is enabled for it, otherwise returns it unchanged
+def memoize_chain(chain, name, validate=None, model=None):
+    try:
+        store = get_llm_memo_store()
+        variety = get_llm_memo_variety(name)
+    except Exception as e:
+        logger.warning("Could not set up llm memo store due to {0}, {1} will not be memoized".format(e, name))
+        return chain
+    if store is None or variety <= 0:
+        return chain
+    return MemoizedChain(chain, name, store, variety, validate, model)
+
+# streams through the chain's memo store when memoization is enabled for it, so streaming does not turn memoization off
+def memoized_stream_split(chain, runnable, inputs, separator=':'):
+    if isinstance(chain, MemoizedChain):
+        return chain.stream_split(runnable, inputs, separator)
+    return stream_split(runnable, inputs, separator)
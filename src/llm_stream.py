@@ -0,0 +1,35 @@
+# Copyright Michael Kukar 2023
+
+import logging
+from concurrent.futures import Future
+from threading import Thread
+
+logger = logging.getLogger('beba')
+
+def get_chunk_text(chunk):
+    # chat models stream message chunks, completion models stream plain strings
+    return chunk.content if hasattr(chunk, 'content') else str(chunk)
+
+def finish_stream(chunks, text, separator, future):
+    try:
+        for chunk in chunks:
+            text += get_chunk_text(chunk)
+        # same handling of extra separators as the non streaming responses
+        future.set_result(text.replace(separator, '-').strip())
+    except Exception as e:
+        logger.warning("Streaming the rest of the response failed due to {0}".format(e))
+        future.set_exception(e)
+
+# streams a response of the form "<answer><separator><reasoning>" from a prompt | llm runnable
+# returns the answer as soon as the separator arrives and a Future for the reasoning, which keeps streaming in the background
+def stream_split(runnable, inputs, separator=':'):
+    chunks = iter(runnable.stream(inputs))
+    text = ''
+    for chunk in chunks:
+        text += get_chunk_text(chunk)
+        if separator in text:
+            answer, reasoning = text.split(separator, 1)
+            reasoning_future = Future()
+            Thread(target=finish_stream, args=(chunks, reasoning, separator, reasoning_future), name='llm_stream', daemon=True).start()
+            return answer.strip(), reasoning_future
+    raise ValueError("Response did not contain the separator {0}: {1}".format(separator, text))
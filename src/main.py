@@ -1,14 +1,22 @@
 # Copyright Michael Kukar 2023
 
-from controller import Controller
+from startup_profiler import startup_profiler
+with startup_profiler.span('import controller'):
+    from controller import Controller
+    from zones import MultiZoneController
 
+from dotenv import load_dotenv
 import logging
+import os
 
 logger = logging.getLogger('beba')
 
 VERSION = "1.6"
 
 if __name__ == "__main__":
-    controller = Controller(VERSION)
-    controller.setup()
+    # setup loads the .env again, this early load only decides which controller runs
+    load_dotenv(os.path.join(os.path.abspath(os.path.dirname(__file__)), '../.env'))
+    controller = MultiZoneController(VERSION) if os.getenv('ZONES') else Controller(VERSION)
+    with startup_profiler.span('setup'):
+        controller.setup()
     controller.start()
@@ -0,0 +1,140 @@
+# Copyright Michael Kukar 2023
+
+import json
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+logger = logging.getLogger('beba')
+
+# latency histograms per stage plus error, retry and cache counters
+# served as prometheus text on a local port and optionally traced to a jsonl file
+class Metrics:
+
+    BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+    STAGE_HISTOGRAM = 'beba_stage_seconds'
+    ERRORS_COUNTER = 'beba_stage_errors_total'
+    RETRIES_COUNTER = 'beba_stage_retries_total'
+    CACHE_HITS_COUNTER = 'beba_cache_hits_total'
+    CACHE_MISSES_COUNTER = 'beba_cache_misses_total'
+
+    def __init__(self):
+        self.histograms = {} # stage -> [bucket counts..., +Inf count, sum]
+        self.counters = {} # (name, label name, label value) -> count
+        self.gauges = {} # name -> function read when rendering, a None reading is left out
+        self.trace_file = None
+        self.server = None
+        self.lock = Lock()
+
+    # times the block as a stage, exceptions are counted as errors for the stage and raised again
+    @contextmanager
+    def span(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.observe(stage, time.monotonic() - start, error=type(e).__name__)
+            raise
+        self.observe(stage, time.monotonic() - start)
+
+    def observe(self, stage, seconds, error=None):
+        with self.lock:
+            histogram = self.histograms.setdefault(stage, [0] * (len(self.BUCKETS) + 1) + [0.0])
+            histogram[bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+            if error is not None:
+                self.increment_locked(self.ERRORS_COUNTER, 'stage', stage)
+            if self.trace_file is not None:
+                try:
+                    self.trace_file.write(json.dumps({'time': time.time(), 'stage': stage, 'seconds': round(seconds, 6), 'error': error}) + '\n')
+                    self.trace_file.flush()
+                except Exception as e:
+                    logger.warning("Could not write metrics trace due to {0}, disabling it".format(e))
+                    self.trace_file = None
+
+    def retry(self, stage):
+        self.increment(self.RETRIES_COUNTER, 'stage', stage)
+
+    def cache(self, cache_name, hit):
+        self.increment(self.CACHE_HITS_COUNTER if hit else self.CACHE_MISSES_COUNTER, 'cache', cache_name)
+
+    def gauge(self, name, read):
+        with self.lock:
+            self.gauges[name] = read
+
+    def increment(self, name, label_name, label_value):
+        with self.lock:
+            self.increment_locked(name, label_name, label_value)
+
+    def increment_locked(self, name, label_name, label_value):
+        key = (name, label_name, label_value)
+        self.counters[key] = self.counters.get(key, 0) + 1
+
+    # prometheus text exposition format
+    def render(self):
+        with self.lock:
+            lines = ["# TYPE {0} histogram".format(self.STAGE_HISTOGRAM)]
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bucket, count in zip(self.BUCKETS + ['+Inf'], histogram[:-1]):
+                    cumulative += count
+                    lines.append('{0}_bucket{{stage="{1}",le="{2}"}} {3}'.format(self.STAGE_HISTOGRAM, stage, bucket, cumulative))
+                lines.append('{0}_sum{{stage="{1}"}} {2}'.format(self.STAGE_HISTOGRAM, stage, histogram[-1]))
+                lines.append('{0}_count{{stage="{1}"}} {2}'.format(self.STAGE_HISTOGRAM, stage, cumulative))
+            gauges = sorted(self.gauges.items())
+            for name in sorted(set([key[0] for key in self.counters])):
+                lines.append("# TYPE {0} counter".format(name))
+                for (counter_name, label_name, label_value), count in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append('{0}{{{1}="{2}"}} {3}'.format(name, label_name, label_value, count))
+        # read outside the lock, a gauge may be slow or record metrics of its own
+        for name, read in gauges:
+            try:
+                value = read()
+            except Exception as e:
+                logger.warning("Could not read gauge {0} due to {1}".format(name, e))
+                continue
+            if value is not None:
+                lines.append("# TYPE {0} gauge".format(name))
+                lines.append("{0} {1}".format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def start_trace(self, path):
+        try:
+            self.trace_file = open(path, 'a')
+        except Exception as e:
+            logger.warning("Could not open metrics trace {0} due to {1}".format(path, e))
+
+    # only listens on localhost, the endpoint is meant for a scraper running on the same unit
+    def start_server(self, port, host='127.0.0.1'):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics endpoint: {0}".format(format % args))
+
+        try:
+            self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        except Exception as e:
+            logger.warning("Could not start metrics endpoint on port {0} due to {1}".format(port, e))
+            return
+        Thread(target=self.server.serve_forever, args=(), name='metrics_server', daemon=True).start()
+        logger.info("Serving metrics on http://{0}:{1}/metrics".format(host, port))
+
+# shared by every module, like the startup profiler
+metrics = Metrics()
@@ -1,13 +1,19 @@
 # Copyright Michael Kukar 2023
 
 from mood_changer import *
+from llm_memo import memoize_chain, memoized_stream_split
+from metrics import metrics
+from history import get_history
 
 import logging
 from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
-from noaa_sdk import NOAA
+from langchain_core.runnables import RunnableLambda
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 import os
 import importlib
+import json
+import time
 
 logger = logging.getLogger('beba')
 
@@ -26,8 +32,63 @@ class Mood:
     MOOD_PROMPT_VARS = ['mood_changer_text']
     MOOD_SPLIT_CHARACTER = ':'
 
+    # mood plan mode gets the mood and the music search in a single call
+    MOOD_PLAN_PROMPT = """
+    Pretend you are a human that can experience moods and feelings and enjoys expressing them. 
+    Given the following information, decide on a unique, creative, and specific mood or feeling
+    that is a single word. Your mood should be intuitive and simple.
+    Your mood should not be reflective, introspective, intrigued, stimulated, enlighted, inspired 
+    or a similar type of mood that is vague or uninteresting.
+    Then decide what type of music you would search for on spotify in that mood. This search can include 
+    specific genres, decades, and or artists or can be more generic depending on what you believe
+    the mood should evoke. For example, your search could be "Upbeat Pop" or it could be "60s pop rock inspired by the beatles"
+    Make your search as specific, unique and verbose as possible while being under ten words.
+    Respond only with a JSON object with exactly these keys:
+    "mood": your single word mood,
+    "mood_reason": a descriptive reasoning for the mood you are now in,
+    "search_query": your music search,
+    "search_query_reason": your descriptive reasoning for deciding this search
+    {mood_changer_text}
+    """
+    MOOD_PLAN_PROMPT_VARS = ['mood_changer_text']
+    # the reply is held to this schema through the model's structured output (function calling)
+    MOOD_PLAN_SCHEMA = {
+        'title': 'mood_plan',
+        'description': "Your mood and the music you would search for on spotify in that mood",
+        'type': 'object',
+        'properties': {
+            'mood': {'type': 'string', 'description': "your single word mood"},
+            'mood_reason': {'type': 'string', 'description': "a descriptive reasoning for the mood you are now in"},
+            'search_query': {'type': 'string', 'description': "your music search, under ten words"},
+            'search_query_reason': {'type': 'string', 'description': "your descriptive reasoning for deciding this search"}
+        },
+        'required': ['mood', 'mood_reason', 'search_query', 'search_query_reason']
+    }
+    MOOD_PLAN_REPAIR_PROMPT = """
+    You were asked to respond with a JSON object describing your mood and the music you want to search for.
+    This is what you have decided so far {mood_plan}
+    The following keys were missing or invalid {invalid_fields}
+    {field_descriptions}
+    Respond only with a JSON object with exactly the keys {invalid_fields}
+    """
+    MOOD_PLAN_REPAIR_PROMPT_VARS = ['mood_plan', 'invalid_fields', 'field_descriptions']
+    MOOD_PLAN_FIELD_DESCRIPTIONS = {
+        'mood': "mood must be a single word mood",
+        'mood_reason': "mood_reason must be a descriptive reasoning for the mood",
+        'search_query': "search_query must be a music search under ten words",
+        'search_query_reason': "search_query_reason must be a descriptive reasoning for the search"
+    }
+
+    # the latest moods from the history the llm is asked not to repeat
+    RECENT_MOODS = 5
+    RECENT_MOODS_SECONDS = 24 * 60 * 60
+
+    # deadline for the whole parallel fetch of all mood changers
+    MOOD_CHANGERS_TIMEOUT_SECONDS = 15.0
+
     current_mood = 'happy'
     current_mood_reason = ''
+    mood_reason_future = None
 
     def __init__(self, llm):
         self.llm = llm
@@ -35,9 +96,20 @@ class Mood:
             input_variables=self.MOOD_PROMPT_VARS,
             template=self.MOOD_PROMPT
         )
-        self.mood_chain = LLMChain(llm=self.llm, prompt=self.mood_prompt_template)
-        self.weather_noaa = NOAA()
+        self.mood_chain = memoize_chain(LLMChain(llm=self.llm, prompt=self.mood_prompt_template), 'mood', lambda text: self.MOOD_SPLIT_CHARACTER in text)
+        self.mood_stream = self.mood_prompt_template | self.llm
+        self.mood_plan_chain = memoize_chain(LLMChain(llm=self.get_mood_plan_llm(), prompt=PromptTemplate(
+            input_variables=self.MOOD_PLAN_PROMPT_VARS,
+            template=self.MOOD_PLAN_PROMPT
+        )), 'mood_plan', lambda text: len(self.parse_mood_plan(text)) == len(self.MOOD_PLAN_FIELD_DESCRIPTIONS), getattr(self.llm, 'model_name', None))
+        self.mood_plan_repair_chain = LLMChain(llm=self.llm, prompt=PromptTemplate(
+            input_variables=self.MOOD_PLAN_REPAIR_PROMPT_VARS,
+            template=self.MOOD_PLAN_REPAIR_PROMPT
+        ))
         self.mood_changers = self.get_enabled_mood_changers()
+        self.history = get_history()
+        self.mood_changers_timeout = float(os.getenv('MOOD_CHANGERS_TIMEOUT_SECONDS')) if os.getenv('MOOD_CHANGERS_TIMEOUT_SECONDS') is not None else self.MOOD_CHANGERS_TIMEOUT_SECONDS
+        self.mood_changer_timeout = float(os.getenv('MOOD_CHANGER_TIMEOUT_SECONDS')) if os.getenv('MOOD_CHANGER_TIMEOUT_SECONDS') is not None else None
 
     def get_enabled_mood_changers(self):
         mood_changers = []
@@ -51,37 +123,150 @@ class Mood:
                 logger.warning("Could not find mood changer with name {0}, will not enable.".format(mood_topic))
         return mood_changers
 
+    def schedule_mood_changer_refreshes(self, scheduler, is_paused):
+        for mood_changer in self.mood_changers:
+            mood_changer.schedule_refresh(scheduler, is_paused)
+
+    def get_mood_changer_deadline(self, mood_changer, start):
+        timeout = self.mood_changer_timeout if self.mood_changer_timeout is not None else mood_changer.FETCH_TIMEOUT_SECONDS
+        return min(start + timeout, start + self.mood_changers_timeout)
+
     # get relevant info that affects our LLMs mood
+    # all mood changers are fetched in parallel, any that miss their deadline or fail are dropped from the prompt
     def get_mood_changers(self):
         mood_changer_state = {}
-        for mood_changer in self.mood_changers:
-            mood_changer_state[mood_changer.get_mood_changer_topic()] = mood_changer.get_mood_changer_summary()
+        if len(self.mood_changers) == 0:
+            return mood_changer_state
+        start = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=len(self.mood_changers), thread_name_prefix='mood_changer')
+        try:
+            futures = [(mood_changer, executor.submit(self.fetch_mood_changer_summary, mood_changer)) for mood_changer in self.mood_changers]
+            for mood_changer, future in futures:
+                topic = mood_changer.get_mood_changer_topic()
+                try:
+                    timeout = max(0.0, self.get_mood_changer_deadline(mood_changer, start) - time.monotonic())
+                    mood_changer_state[topic] = future.result(timeout=timeout)
+                except FuturesTimeoutError:
+                    logger.warning("Mood changer {0} missed its deadline, dropping it from the prompt".format(topic))
+                except Exception as e:
+                    logger.warning("Mood changer {0} failed due to {1}, dropping it from the prompt".format(topic, e))
+        finally:
+            # never wait on a stalled mood changer, its thread finishes in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+        logger.debug("Fetched {0} of {1} mood changers in {2:.2f}s".format(len(mood_changer_state), len(self.mood_changers), time.monotonic() - start))
         return mood_changer_state
 
+    def fetch_mood_changer_summary(self, mood_changer):
+        with metrics.span("mood_changer.{0}".format(mood_changer.get_mood_changer_topic())):
+            return mood_changer.get_mood_changer_summary()
+
     def format_mood_changers_into_text(self, mood_changers):
         mood_changer_text = ''
         for topic, summary in mood_changers.items():
             mood_changer_text += "{0}\n".format(summary)
         return mood_changer_text
 
-    def determine_mood(self, retry=True):
-        try:
-            mood_changers = self.get_mood_changers()
-            logger.debug("Mood changers: {0}".format(str(mood_changers)))
-            mood_changer_text = self.format_mood_changers_into_text(mood_changers)
-            logger.debug("Mood changer text: {0}".format(mood_changer_text))
+    def get_mood_changer_text(self):
+        mood_changers = self.get_mood_changers()
+        logger.debug("Mood changers: {0}".format(str(mood_changers)))
+        mood_changer_text = self.format_mood_changers_into_text(mood_changers) + self.get_recent_moods_text()
+        logger.debug("Mood changer text: {0}".format(mood_changer_text))
+        return mood_changer_text
+
+    def get_recent_moods_text(self):
+        if self.history is None:
+            return ''
+        recent_moods = list(dict.fromkeys(reversed(self.history.get_moods(self.RECENT_MOODS_SECONDS))))[:self.RECENT_MOODS]
+        if len(recent_moods) == 0:
+            return ''
+        return "You have recently felt {0}, so your mood now should be different\n".format(', '.join(recent_moods))
+
+    # works out a mood and its reasoning without changing the current mood
+    def generate_mood(self, mood_changer_text):
+        with metrics.span('llm.mood'):
             mood_response = self.mood_chain.invoke({'mood_changer_text' : mood_changer_text})
-            logger.debug("LLM response: {0}".format(mood_response))
-            if len(mood_response['text'].split(':')) > 2: # handling extra colons
-                split_response = mood_response['text'].split(':')
-                mood_response['text'] = split_response[0] + '-'.join(split_response[1:])
-            self.current_mood, self.current_mood_reason = [x.strip() for x in mood_response['text'].split(self.MOOD_SPLIT_CHARACTER)]
-            logger.info("New mood: {0}".format(self.current_mood))
-        except Exception as e:
-            if retry:
-                logger.warning("Determining mood failed due to {0}, retrying...".format(e))
-                return self.determine_mood(retry=False)
-            else:
-                logger.error(e)
-                raise e
-        return self.current_mood
+        logger.debug("LLM response: {0}".format(mood_response))
+        if len(mood_response['text'].split(':')) > 2: # handling extra colons
+            split_response = mood_response['text'].split(':')
+            mood_response['text'] = split_response[0] + '-'.join(split_response[1:])
+        mood, mood_reason = [x.strip() for x in mood_response['text'].split(self.MOOD_SPLIT_CHARACTER)]
+        return mood, mood_reason
+
+    # returns the mood word as soon as it arrives and a Future for the reasoning that is still streaming in
+    def stream_mood(self, mood_changer_text):
+        with metrics.span('llm.mood_stream_answer'):
+            return memoized_stream_split(self.mood_chain, self.mood_stream, {'mood_changer_text' : mood_changer_text}, self.MOOD_SPLIT_CHARACTER)
+
+    # a reasoning future fills in the reasoning once it finishes streaming
+    def set_mood(self, mood, mood_reason, mood_reason_future=None):
+        self.current_mood, self.current_mood_reason = mood, mood_reason
+        self.mood_reason_future = mood_reason_future
+        if mood_reason_future is not None:
+            mood_reason_future.add_done_callback(self.set_streamed_mood_reason)
+        logger.info("New mood: {0}".format(self.current_mood))
+
+    def set_streamed_mood_reason(self, future):
+        # a newer mood may have started streaming since, its reasoning wins
+        if future is self.mood_reason_future and future.exception() is None:
+            self.current_mood_reason = future.result()
+            logger.debug("Mood reasoning: {0}".format(self.current_mood_reason))
+
+    # validators for each field of a mood plan
+    @staticmethod
+    def is_valid_mood_plan_field(field, value):
+        if not isinstance(value, str) or len(value.strip()) == 0:
+            return False
+        if field == 'mood':
+            return len(value.split()) == 1
+        if field == 'search_query':
+            return len(value.split()) < 10
+        return True
+
+    # structured output comes back as a dict, it is turned back into json text so the chain and the memo store stay text
+    # models without structured output answer in plain text, parse_mood_plan finds the json in it
+    def get_mood_plan_llm(self):
+        try:
+            return self.llm.with_structured_output(self.MOOD_PLAN_SCHEMA) | RunnableLambda(lambda mood_plan: json.dumps(mood_plan or {}))
+        except NotImplementedError:
+            logger.warning("LLM has no structured output, mood plans are parsed from plain text")
+            return self.llm
+
+    # returns only the valid fields of the llm response, so the rest can be asked for again
+    def parse_mood_plan(self, text):
+        try:
+            response = json.loads(text)
+        except ValueError:
+            try:
+                # a plain text reply can have text around the json object
+                response = json.loads(text[text.index('{'):text.rindex('}') + 1])
+            except ValueError:
+                logger.warning("Mood plan response was not JSON: {0}".format(text))
+                return {}
+        if not isinstance(response, dict):
+            return {}
+        return {field: response[field].strip().replace(':', '-') for field in self.MOOD_PLAN_FIELD_DESCRIPTIONS if self.is_valid_mood_plan_field(field, response.get(field))}
+
+    # works out the mood and the music search query in one llm call without changing the current mood
+    def generate_mood_plan(self, mood_changer_text):
+        with metrics.span('llm.mood_plan'):
+            mood_plan_response = self.mood_plan_chain.invoke({'mood_changer_text' : mood_changer_text})
+        logger.debug("LLM response: {0}".format(mood_plan_response))
+        mood_plan = self.parse_mood_plan(mood_plan_response['text'])
+        invalid_fields = [field for field in self.MOOD_PLAN_FIELD_DESCRIPTIONS if field not in mood_plan]
+        if len(invalid_fields) > 0 and len(mood_plan) > 0:
+            # only ask again for what is missing instead of starting over
+            logger.warning("Mood plan fields {0} invalid, asking again for them...".format(invalid_fields))
+            metrics.retry('llm.mood_plan')
+            with metrics.span('llm.mood_plan_repair'):
+                repair_response = self.mood_plan_repair_chain.invoke({
+                    'mood_plan' : json.dumps(mood_plan),
+                    'invalid_fields' : ', '.join(invalid_fields),
+                    'field_descriptions' : '\n'.join([self.MOOD_PLAN_FIELD_DESCRIPTIONS[field] for field in invalid_fields])
+                })
+            logger.debug("LLM response: {0}".format(repair_response))
+            repaired_plan = self.parse_mood_plan(repair_response['text'])
+            mood_plan.update({field: value for field, value in repaired_plan.items() if field in invalid_fields})
+            invalid_fields = [field for field in self.MOOD_PLAN_FIELD_DESCRIPTIONS if field not in mood_plan]
+        if len(invalid_fields) > 0:
+            raise ValueError("Mood plan is missing {0}".format(invalid_fields))
+        return mood_plan
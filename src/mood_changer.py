@@ -2,15 +2,77 @@
 
 import os
 from abc import ABC, abstractmethod
-from noaa_sdk import NOAA
 import logging
-import requests, json
+import json
 import random
+import time
+from concurrent.futures import Future, TimeoutError as FuturesTimeoutError
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from threading import Lock, Thread
+
+from cache import TTLCache
+from http_client import HttpClient, TokenBucket
+from article_pool import ArticlePool
+from metrics import metrics
 
 logger = logging.getLogger('beba')
 
+# NYTimes allows 5 requests a minute per api key
+NYTIMES_REQUESTS_PER_MINUTE = 5.0
+
+nytimes_client = None
+nytimes_client_lock = Lock()
+
+# one pooled client shared by every NYTimes mood changer so they share connections and the request budget
+def get_nytimes_client() -> HttpClient:
+    global nytimes_client
+    with nytimes_client_lock:
+        if nytimes_client is None:
+            requests_per_minute = float(os.getenv('NYTIMES_REQUESTS_PER_MINUTE')) if os.getenv('NYTIMES_REQUESTS_PER_MINUTE') is not None else NYTIMES_REQUESTS_PER_MINUTE
+            nytimes_client = HttpClient('nytimes', rate_limiter=TokenBucket(requests_per_minute, requests_per_minute / 60.0))
+        return nytimes_client
+
 class MoodChanger(ABC):
 
+    # how long a single fetch may take before it is dropped from the mood prompt
+    FETCH_TIMEOUT_SECONDS = 10.0
+
+    # how long fetched source data is reused before fetching again, overridden per source
+    CACHE_TTL_SECONDS = 60 * 60
+    CACHE_MAX_ENTRIES = 128
+
+    # shared by all mood changers so every source is bounded by the same size limit
+    cache = None
+    cache_lock = Lock()
+
+    @staticmethod
+    def get_cache() -> TTLCache:
+        with MoodChanger.cache_lock:
+            if MoodChanger.cache is None:
+                max_entries = int(os.getenv('MOOD_CHANGER_CACHE_MAX_ENTRIES')) if os.getenv('MOOD_CHANGER_CACHE_MAX_ENTRIES') is not None else MoodChanger.CACHE_MAX_ENTRIES
+                MoodChanger.cache = TTLCache(max_entries=max_entries, path=os.getenv('MOOD_CHANGER_CACHE_PATH') or None)
+            return MoodChanger.cache
+
+    # returns cached data for the endpoint, only calling fetch when missing or expired
+    # empty results (failed requests) are not cached so the next mood change tries again
+    def get_cached(self, endpoint, fetch, ttl_seconds=None):
+        cache = self.get_cache()
+        data = cache.get(endpoint)
+        metrics.cache('mood_changer', data is not None)
+        if data is not None:
+            logger.debug("Using cached data for {0}".format(endpoint))
+            return data
+        data = fetch()
+        if data:
+            cache.set(endpoint, data, ttl_seconds if ttl_seconds is not None else self.CACHE_TTL_SECONDS)
+        return data
+
+    # mood changers that keep their data fresh in the background schedule it here
+    # is_paused tells them when to hold off, such as during quiet hours
+    def schedule_refresh(self, scheduler, is_paused):
+        return
+
     @abstractmethod
     def get_mood_changer_topic(self) -> str:
         # should be the topic of the mood changer, such as "weather"
@@ -25,18 +87,133 @@ class MoodChanger(ABC):
 class WeatherMoodChanger(MoodChanger):
 
     TOPIC = "weather"
+    GEOCODE_ENDPOINT = "https://nominatim.openstreetmap.org/"
+    POINTS_ENDPOINT = "https://api.weather.gov/"
+    FORECASTS_ENDPOINT = "noaa/forecasts/{0}/{1}"
+    GRIDPOINT_ENDPOINT = "noaa/gridpoint/{0}/{1}"
+    # noaa asks for a user agent that identifies the app
+    USER_AGENT = "beba (https://github.com/mkukar/beba)"
+    # a forecast without expiry headers is reused until it is this old, hourly forecasts update about every hour
+    CACHE_TTL_SECONDS = 60 * 60
+    MIN_FORECAST_TTL_SECONDS = 60
+    # how long a mood change waits on a forecast refresh before using the last good forecast
+    STALE_WAIT_SECONDS = 3.0
 
+    # refreshes in flight, shared by all weather mood changers so only one request is made per forecast
+    forecast_refreshes = {}
+    forecast_refreshes_lock = Lock()
+
+    # every lookup goes through the client's timeouts, a stalled socket can not hold up a refresh forever
     def __init__(self):
-        self.weather_noaa = NOAA()
+        self.noaa_client = HttpClient('noaa', max_retries=1)
 
     def get_mood_changer_topic(self) -> str:
         return self.TOPIC
 
+    def get_json(self, url, params=None):
+        response = self.noaa_client.get(url, params=params, headers={'User-Agent': self.USER_AGENT, 'Accept': 'application/geo+json, application/json'})
+        response.raise_for_status()
+        return json.loads(response.content)
+
+    def get_lat_lon(self, zip_code, country_code):
+        places = self.get_json("{0}search".format(self.GEOCODE_ENDPOINT), params={'postalcode': zip_code, 'country': country_code, 'format': 'json'})
+        if len(places) == 0 or 'lat' not in places[0] or 'lon' not in places[0]:
+            raise LookupError("Could not find zip code {0} in {1}".format(zip_code, country_code))
+        return float(places[0]['lat']), float(places[0]['lon'])
+
+    # the zip code never moves, so the geocode and points lookups are done once and kept without expiry
+    def get_forecast_url(self, zip_code, country_code):
+        endpoint = self.GRIDPOINT_ENDPOINT.format(zip_code, country_code)
+        gridpoint = self.get_cache().get(endpoint)
+        if gridpoint is None:
+            lat, lon = self.get_lat_lon(zip_code, country_code)
+            points = self.get_json("{0}points/{1:.4f},{2:.4f}".format(self.POINTS_ENDPOINT, lat, lon))
+            gridpoint = {'forecast_url': points['properties']['forecastHourly']}
+            logger.info("Resolved NOAA gridpoint for {0} to {1}".format(zip_code, gridpoint['forecast_url']))
+            self.get_cache().set(endpoint, gridpoint)
+        return gridpoint['forecast_url']
+
+    # how long the forecast can be reused, from the expires header or else the forecast's own update time
+    def get_forecast_expires_at(self, response, forecast_data):
+        try:
+            if response.headers.get('Expires'):
+                expires_at = parsedate_to_datetime(response.headers['Expires']).timestamp()
+            else:
+                expires_at = datetime.fromisoformat(forecast_data['properties']['updateTime']).timestamp() + self.CACHE_TTL_SECONDS
+        except Exception as e:
+            logger.debug("Could not read the forecast expiry due to {0}".format(e))
+            expires_at = time.time() + self.CACHE_TTL_SECONDS
+        return min(max(expires_at, time.time() + self.MIN_FORECAST_TTL_SECONDS), time.time() + self.CACHE_TTL_SECONDS)
+
+    # one request, asking noaa to answer 304 with no body if the forecast has not changed since the last one
+    def fetch_forecast(self, zip_code, country_code, last_forecast=None):
+        forecast_url = self.get_forecast_url(zip_code, country_code)
+        headers = {'User-Agent': self.USER_AGENT, 'Accept': 'application/geo+json'}
+        if last_forecast is not None and last_forecast.get('last_modified'):
+            headers['If-Modified-Since'] = last_forecast['last_modified']
+        response = self.noaa_client.get(forecast_url, headers=headers)
+        if response.status_code == 304 and last_forecast is not None:
+            forecast = dict(last_forecast)
+            forecast['expires_at'] = self.get_forecast_expires_at(response, None)
+            return forecast
+        if response.status_code == 404:
+            # the gridpoint for the zip code changed, resolve it again next time
+            self.get_cache().delete(self.GRIDPOINT_ENDPOINT.format(zip_code, country_code))
+        response.raise_for_status()
+        forecast_data = json.loads(response.content)
+        return {
+            'periods': forecast_data['properties']['periods'],
+            'last_modified': response.headers.get('Last-Modified'),
+            'expires_at': self.get_forecast_expires_at(response, forecast_data)
+        }
+
+    def refresh_forecast(self, zip_code, country_code, last_forecast, future):
+        try:
+            forecast = self.fetch_forecast(zip_code, country_code, last_forecast)
+            # kept without a ttl so the last good forecast is there when noaa is down, its own expiry says when to refresh
+            self.get_cache().set(self.FORECASTS_ENDPOINT.format(zip_code, country_code), forecast)
+            future.set_result(forecast)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            self.drop_forecast_refresh(zip_code, country_code, future)
+
+    # a refresh that was given up on may already have been replaced by a newer one
+    def drop_forecast_refresh(self, zip_code, country_code, future):
+        with self.forecast_refreshes_lock:
+            if self.forecast_refreshes.get((zip_code, country_code)) is future:
+                del self.forecast_refreshes[(zip_code, country_code)]
+
+    def get_forecasts(self, zip_code, country_code):
+        forecast = self.get_cache().get(self.FORECASTS_ENDPOINT.format(zip_code, country_code))
+        metrics.cache('mood_changer', forecast is not None and forecast['expires_at'] > time.time())
+        if forecast is not None and forecast['expires_at'] > time.time():
+            return forecast['periods']
+        with self.forecast_refreshes_lock:
+            future = self.forecast_refreshes.get((zip_code, country_code))
+            if future is None:
+                future = Future()
+                self.forecast_refreshes[(zip_code, country_code)] = future
+                Thread(target=self.refresh_forecast, args=(zip_code, country_code, forecast, future), name='forecast_refresh', daemon=True).start()
+        if forecast is None:
+            try:
+                return future.result(timeout=self.FETCH_TIMEOUT_SECONDS)['periods']
+            except FuturesTimeoutError:
+                # the next mood change starts a new refresh instead of waiting on this one
+                self.drop_forecast_refresh(zip_code, country_code, future)
+                raise
+        try:
+            return future.result(timeout=self.STALE_WAIT_SECONDS)['periods']
+        except Exception as e:
+            # a slow refresh keeps going in the background for the next mood change
+            logger.warning("Using the last good forecast as NOAA did not answer in time ({0})".format(type(e).__name__))
+            return forecast['periods']
+
     def get_mood_changer_summary(self) -> str:
-        shortForecast = next(iter(self.weather_noaa.get_forecasts(
-            os.getenv('WEATHER_ZIP_CODE'), 
-            os.getenv('WEATHER_COUNTRY_CODE')
-            )), {'shortForecast' : ''})['shortForecast']
+        zip_code = os.getenv('WEATHER_ZIP_CODE')
+        country_code = os.getenv('WEATHER_COUNTRY_CODE')
+        forecasts = self.get_forecasts(zip_code, country_code)
+        shortForecast = next(iter(forecasts), {'shortForecast' : ''})['shortForecast']
         return "The weather is {0}".format(shortForecast).replace(':', '-')
 
 
@@ -48,10 +225,14 @@ class BooksMoodChanger(MoodChanger):
 
     TOPIC = "books"
 
+    # list names rarely change, the lists themselves are updated weekly
+    LIST_NAMES_TTL_SECONDS = 24 * 60 * 60
+    CACHE_TTL_SECONDS = 6 * 60 * 60
+
     literature_lists = []
 
     def get_list_names(self):
-        response = requests.get("{0}{1}?api-key={2}".format(self.BASE_ENDPOINT, self.LIST_NAMES_URI, os.getenv('NYTIMES_API_KEY')))
+        response = get_nytimes_client().get("{0}{1}".format(self.BASE_ENDPOINT, self.LIST_NAMES_URI), params={'api-key': os.getenv('NYTIMES_API_KEY')})
         if not response.ok:
             logger.error("Error with request, will not be able to use the topic {0}".format(self.get_mood_changer_topic()))
             logger.error("{0}".format(response))
@@ -66,7 +247,7 @@ class BooksMoodChanger(MoodChanger):
                 return []
 
     def get_list_data(self, list_name):
-        response = requests.get("{0}{1}?api-key={2}".format(self.BASE_ENDPOINT, self.LIST_INFO_URI.format(list_name), os.getenv('NYTIMES_API_KEY')))
+        response = get_nytimes_client().get("{0}{1}".format(self.BASE_ENDPOINT, self.LIST_INFO_URI.format(list_name)), params={'api-key': os.getenv('NYTIMES_API_KEY')})
         if not response.ok:
             logger.error("Error with request, will not be able to use the topic {0}".format(self.get_mood_changer_topic()))
             logger.error("{0}".format(response))
@@ -80,9 +261,9 @@ class BooksMoodChanger(MoodChanger):
 
     def get_mood_changer_summary(self) -> str:
         # gets random book that it "read" recently
-        self.literature_lists = self.get_list_names()
+        self.literature_lists = self.get_cached("{0}{1}".format(self.BASE_ENDPOINT, self.LIST_NAMES_URI), self.get_list_names, self.LIST_NAMES_TTL_SECONDS)
         random_list = random.choice(self.literature_lists)
-        lit_data = self.get_list_data(random_list)
+        lit_data = self.get_cached("{0}{1}".format(self.BASE_ENDPOINT, self.LIST_INFO_URI.format(random_list)), lambda: self.get_list_data(random_list))
         self.current_book = random.choice(lit_data)
         return 'You have recently read {0} by {1} with the description {2}'.format(self.current_book['title'], self.current_book['author'], self.current_book['description']).replace(':', '-')
 
@@ -94,9 +275,10 @@ class MoviesMoodChanger(MoodChanger):
     CRITIC_PICS_URI = "svc/movies/v2/reviews/picks.json"
 
     TOPIC = "movies"
+    CACHE_TTL_SECONDS = 24 * 60 * 60
 
     def get_movie_critic_picks(self):
-        response = requests.get("{0}{1}?api-key={2}".format(self.BASE_ENDPOINT, self.CRITIC_PICS_URI, os.getenv('NYTIMES_API_KEY')))
+        response = get_nytimes_client().get("{0}{1}".format(self.BASE_ENDPOINT, self.CRITIC_PICS_URI), params={'api-key': os.getenv('NYTIMES_API_KEY')})
         if not response.ok:
             logger.error("Error with request, will not be able to use the topic {0}".format(self.get_mood_changer_topic()))
             logger.error("{0}".format(response))
@@ -112,7 +294,7 @@ class MoviesMoodChanger(MoodChanger):
     
     def get_mood_changer_summary(self) -> str:
         # gets a random movie from critics picks that it "watched" recently
-        self.critic_picks = self.get_movie_critic_picks()
+        self.critic_picks = self.get_cached("{0}{1}".format(self.BASE_ENDPOINT, self.CRITIC_PICS_URI), self.get_movie_critic_picks)
         self.current_movie = random.choice(self.critic_picks)
         return 'You have recently watched {0} with the summary {1}'.format(self.current_movie['display_title'], self.current_movie['summary_short']).replace(':', '-')
 
@@ -121,29 +303,60 @@ class NewsMoodChanger(MoodChanger):
 
     TOPIC = "news"
     # see possible sections here https://developer.nytimes.com/docs/top-stories-product/1/overview
-    NEWS_SECTIONS = ['home', 'science', 'arts', 'business', 'fashion', 'food', 'health', 'home', 'opinion', 'politics', 'sports', 'technology', 'theater', 'travel', 'us', 'world']
+    NEWS_SECTIONS = ['home', 'science', 'arts', 'business', 'fashion', 'food', 'health', 'opinion', 'politics', 'sports', 'technology', 'theater', 'travel', 'us', 'world']
     BASE_ENDPOINT = "https://api.nytimes.com/"
     TOP_STORIES_URI = "svc/topstories/v2/{0}.json"
 
+    # every section costs one request per refresh, 15 sections every 3 hours stays well inside the daily api quota
+    REFRESH_SECONDS = 3 * 60 * 60
+
+    # shared by all news mood changers so the sections are only fetched once
+    article_pool = None
+    article_pool_lock = Lock()
+
     def get_mood_changer_topic(self) -> str:
         return self.TOPIC
-    
+
+    def get_article_pool(self) -> ArticlePool:
+        with NewsMoodChanger.article_pool_lock:
+            if NewsMoodChanger.article_pool is None:
+                refresh_seconds = 60.0 * float(os.getenv('NEWS_REFRESH_MINUTES')) if os.getenv('NEWS_REFRESH_MINUTES') is not None else self.REFRESH_SECONDS
+                NewsMoodChanger.article_pool = ArticlePool(self.TOPIC, self.NEWS_SECTIONS, self.fetch_news_stories, self.is_article,
+                                                           refresh_seconds, self.load_cached_news_stories)
+            return NewsMoodChanger.article_pool
+
+    def schedule_refresh(self, scheduler, is_paused):
+        self.get_article_pool().start(scheduler, is_paused)
+
     def get_news_stories(self, section):
-        response = requests.get("{0}{1}?api-key={2}".format(self.BASE_ENDPOINT, self.TOP_STORIES_URI.format(section), os.getenv('NYTIMES_API_KEY')))
+        response = get_nytimes_client().get("{0}{1}".format(self.BASE_ENDPOINT, self.TOP_STORIES_URI.format(section)), params={'api-key': os.getenv('NYTIMES_API_KEY')})
         if not response.ok:
             logger.error("Error with request, will not be able to use the topic {0}".format(self.get_mood_changer_topic()))
             logger.error("{0}".format(response))
             return []
         else:
             list_data = json.loads(response.content)
-            return list_data['results']
+            return list_data.get('results') or []
+
+    # the pool decides when a section is fetched again from when it was fetched, the cache only carries both over a restart
+    def fetch_news_stories(self, section):
+        articles = self.get_news_stories(section)
+        if articles:
+            self.get_cache().set("{0}{1}".format(self.BASE_ENDPOINT, self.TOP_STORIES_URI.format(section)), {'articles': articles, 'fetched_at': time.time()})
+        return articles
+
+    def load_cached_news_stories(self, section):
+        cached = self.get_cache().get("{0}{1}".format(self.BASE_ENDPOINT, self.TOP_STORIES_URI.format(section)))
+        if not isinstance(cached, dict):
+            return None
+        return cached['articles'], cached['fetched_at']
+
+    # sometimes has ads, etc. that are not really "articles" in the API response
+    @staticmethod
+    def is_article(article):
+        return isinstance(article, dict) and all([article.get(key) for key in ['section', 'title', 'abstract']])
 
     def get_mood_changer_summary(self) -> str:
         # flips to a random page of the newspaper and reads an article
-        section = random.choice(self.NEWS_SECTIONS)
-        articles = self.get_news_stories(section)
-        self.current_article = {}
-        while 'section' not in self.current_article or 'title' not in self.current_article or 'abstract' not in self.current_article:
-            # sometimes has ads, etc. that are not really "articles" in the API response
-            self.current_article = random.choice(articles)
-        return 'You have recently read an article in the {0} section with the title {1} and abstract {2}'.format(self.current_article['section'], self.current_article['title'], self.current_article['abstract']).replace(':', '-')
\ No newline at end of file
+        self.current_article = self.get_article_pool().draw(self.FETCH_TIMEOUT_SECONDS)
+        return 'You have recently read an article in the {0} section with the title {1} and abstract {2}'.format(self.current_article['section'], self.current_article['title'], self.current_article['abstract']).replace(':', '-')
@@ -0,0 +1,127 @@
+# Copyright Michael Kukar 2023
+
+import difflib
+import logging
+import os
+import re
+from pathlib import Path
+from threading import Lock
+
+from cache import TTLCache
+
+logger = logging.getLogger('beba')
+
+# index of mood icons on disk so moods that already have an icon skip image generation
+class MoodIconStore:
+
+    INDEX_FILE_NAME = "index.json"
+    ICON_EXTENSION = ".png"
+
+    MAX_GENERATED_ICONS = 100
+    MATCH_CUTOFF = 0.85
+
+    # near-synonyms that should reuse an existing icon, applied after normalizing
+    SYNONYMS = {
+        'joyful': 'happy', 'cheerful': 'happy', 'content': 'happy', 'glad': 'happy', 'elated': 'happy',
+        'furious': 'angry', 'mad': 'angry', 'irritated': 'angry', 'annoyed': 'angry',
+        'sorrowful': 'sad', 'melancholy': 'sad', 'melancholic': 'sad', 'gloomy': 'sad', 'blue': 'sad',
+        'tearful': 'crying', 'heartbroken': 'crying',
+        'tired': 'sleeping', 'sleepy': 'sleeping', 'drowsy': 'sleeping',
+        'amused': 'lol', 'giddy': 'lol',
+        'romantic': 'inlove', 'loving': 'inlove', 'smitten': 'inlove', 'affectionate': 'kiss',
+        'astonished': 'surprised', 'amazed': 'surprised', 'startled': 'shocker', 'shocked': 'shocker',
+        'perplexed': 'confused', 'bewildered': 'confused', 'baffled': 'puzzled',
+        'mischievous': 'evil', 'devious': 'evil',
+        'playful': 'tongueout', 'silly': 'tongueout', 'cheeky': 'wink', 'flirty': 'wink',
+        'nauseous': 'vomiting', 'queasy': 'vomiting',
+        'serene': 'angel', 'peaceful': 'angel', 'calm': 'angel', 'tranquil': 'angel',
+        'quiet': 'silent', 'geeky': 'nerd', 'studious': 'nerd',
+        'festive': 'santa', 'wintry': 'snowman', 'spooky': 'witch', 'eerie': 'witch',
+        'confident': 'cool', 'relaxed': 'cool', 'chill': 'cool',
+        'regal': 'monarch', 'majestic': 'monarch', 'heroic': 'batman',
+        'hungry': 'drooling', 'wild': 'crazy', 'manic': 'crazy', 'aggressive': 'attack',
+    }
+    SUFFIXES = ['ness', 'ful', 'ish', 'ed', 'ing', 'ly', 'y']
+
+    def __init__(self, icon_dir, max_generated_icons=MAX_GENERATED_ICONS, match_cutoff=MATCH_CUTOFF):
+        self.icon_dir = Path(icon_dir)
+        self.match_cutoff = match_cutoff
+        # normalized mood -> icon file stem of icons bundled with beba or placed in the directory by hand, never removed
+        self.pinned = {}
+        # normalized mood -> icon file stem of generated icons, the least recently used is removed once there are too many
+        self.generated = TTLCache(max_generated_icons, str(self.icon_dir / self.INDEX_FILE_NAME))
+        self.lock = Lock()
+        self.load()
+
+    @staticmethod
+    def normalize(mood_text):
+        return re.sub('[^a-z]', '', mood_text.lower())
+
+    # crude stemming so happy, happiness and happily share an icon
+    def stem(self, mood):
+        for suffix in self.SUFFIXES:
+            if mood.endswith(suffix) and len(mood) - len(suffix) >= 3:
+                mood = mood[:-len(suffix)]
+                break
+        return mood[:-1] if mood[-1:] in ['i', 'y'] and len(mood) > 3 else mood
+
+    # returns the name of an existing icon for the mood, or None if one needs to be generated
+    # a hit is only noted in memory, lookups never write the index
+    def lookup(self, mood_text):
+        mood = self.normalize(mood_text)
+        with self.lock:
+            match = self.find_match(mood)
+            icon_name = (self.pinned.get(match) or self.generated.get(match)) if match is not None else None
+            if icon_name is None:
+                logger.debug("No existing icon for mood {0}".format(mood_text))
+                return None
+            if not (self.icon_dir / "{0}{1}".format(icon_name, self.ICON_EXTENSION)).exists():
+                logger.warning("Icon {0} is indexed but missing, removing it".format(icon_name))
+                self.pinned.pop(match, None)
+                self.generated.delete(match)
+                return None
+            logger.debug("Reusing icon {0} for mood {1}".format(icon_name, mood_text))
+            return icon_name
+
+    # normalized mood -> icon file stem of every icon
+    def get_index(self):
+        index = dict(self.generated.items())
+        index.update(self.pinned)
+        return index
+
+    def find_match(self, mood):
+        index = self.get_index()
+        if mood in index:
+            return mood
+        if self.SYNONYMS.get(mood) in index:
+            return self.SYNONYMS[mood]
+        stemmed_index = {self.stem(indexed_mood): indexed_mood for indexed_mood in index}
+        if self.stem(mood) in stemmed_index:
+            return stemmed_index[self.stem(mood)]
+        close_matches = difflib.get_close_matches(mood, index.keys(), n=1, cutoff=self.match_cutoff)
+        return close_matches[0] if close_matches else None
+
+    def add(self, mood_text, icon_name):
+        with self.lock:
+            for _, evicted_icon_name in self.generated.set(self.normalize(mood_text), icon_name):
+                if evicted_icon_name not in self.get_index().values():
+                    self.remove_icon(evicted_icon_name)
+
+    def remove_icon(self, icon_name):
+        icon_path = self.icon_dir / "{0}{1}".format(icon_name, self.ICON_EXTENSION)
+        logger.info("Evicting mood icon {0}".format(icon_path))
+        try:
+            os.remove(icon_path)
+        except OSError as e:
+            logger.warning("Could not remove mood icon {0} due to {1}".format(icon_path, e))
+
+    # icons in the directory the generated index does not know of were bundled with beba or placed there by hand
+    def load(self):
+        generated_icons = [icon_name for _, icon_name in self.generated.items()]
+        for icon_path in self.icon_dir.glob("*{0}".format(self.ICON_EXTENSION)):
+            if icon_path.stem not in generated_icons:
+                self.pinned.setdefault(self.normalize(icon_path.stem), icon_path.stem)
+
+    # writes out which icons were used since the last new one, called on exit
+    def flush(self):
+        self.generated.flush()
@@ -0,0 +1,91 @@
+# Copyright Michael Kukar 2023
+
+import logging
+import time
+from threading import Event
+
+from metrics import metrics
+
+logger = logging.getLogger('beba')
+
+
+class MoodPipelineCancelled(Exception):
+    pass
+
+
+# handed to a mood pipeline run so a newer request can stop it at the next stage boundary
+class CancellationToken:
+
+    def __init__(self):
+        self.cancelled = Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+    def check(self, stage):
+        if self.cancelled.is_set():
+            raise MoodPipelineCancelled("Cancelled before {0}".format(stage))
+
+
+# a mood and the playlist found for it, worked out without touching the current mood
+# the reasoning futures are set when the reasoning is still streaming in
+class MoodCandidate:
+
+    def __init__(self, mood, mood_reason, search_query, search_query_reason, playlist, mood_reason_future=None, search_query_reason_future=None):
+        self.mood = mood
+        self.mood_reason = mood_reason
+        self.search_query = search_query
+        self.search_query_reason = search_query_reason
+        self.playlist = playlist
+        self.mood_reason_future = mood_reason_future
+        self.search_query_reason_future = search_query_reason_future
+        self.created_at = time.monotonic()
+
+    def get_age_seconds(self):
+        return time.monotonic() - self.created_at
+
+
+# the network heavy part of a mood change split into stages: mood changers, mood, search query, playlist
+# nothing here changes the current mood, so it can run without holding the mood lock
+class MoodPipeline:
+
+    def __init__(self, mood, music, mood_plan_mode=False, stream=False):
+        self.mood = mood
+        self.music = music
+        self.mood_plan_mode = mood_plan_mode
+        self.stream = stream
+
+    # llm stages are tried twice, like determining the mood always has been
+    def run_stage(self, stage, token, function, *args):
+        token.check(stage)
+        try:
+            return function(*args)
+        except Exception as e:
+            logger.warning("Mood pipeline stage {0} failed due to {1}, retrying...".format(stage, e))
+            metrics.retry("llm.{0}".format(stage.replace(' ', '_')))
+            token.check(stage)
+            return function(*args)
+
+    def build(self, token, stream=None):
+        stream = self.stream if stream is None else stream
+        mood_reason_future, search_query_reason_future = None, None
+        token.check('mood changers')
+        mood_changer_text = self.mood.get_mood_changer_text()
+        if self.mood_plan_mode:
+            mood_plan = self.run_stage('mood plan', token, self.mood.generate_mood_plan, mood_changer_text)
+            mood, mood_reason = mood_plan['mood'], mood_plan['mood_reason']
+            search_query, search_query_reason = mood_plan['search_query'], mood_plan['search_query_reason']
+        elif stream:
+            mood, mood_reason_future = self.run_stage('mood', token, self.mood.stream_mood, mood_changer_text)
+            search_query, search_query_reason_future = self.run_stage('search query', token, self.music.stream_search_query, mood)
+            mood_reason, search_query_reason = '', ''
+        else:
+            mood, mood_reason = self.run_stage('mood', token, self.mood.generate_mood, mood_changer_text)
+            search_query, search_query_reason = self.run_stage('search query', token, self.music.generate_search_query, mood)
+        token.check('playlist search')
+        playlist = self.music.find_playlist(search_query, mood)
+        token.check('commit')
+        return MoodCandidate(mood, mood_reason, search_query, search_query_reason, playlist, mood_reason_future, search_query_reason_future)
@@ -0,0 +1,79 @@
+# Copyright Michael Kukar 2023
+
+import logging
+import time
+from threading import Event, Lock, Thread
+
+from mood_pipeline import CancellationToken, MoodPipelineCancelled
+
+logger = logging.getLogger('beba')
+
+# builds the next mood and playlist in the background so a mood change only has to start playback
+# a candidate is dropped once it is older than the mood changer data it was built from
+class MoodPrefetcher:
+
+    # how long a mood change waits on a build that is already running instead of starting its own
+    TAKE_WAIT_SECONDS = 30.0
+
+    def __init__(self, pipeline, max_age_seconds):
+        self.pipeline = pipeline
+        self.max_age_seconds = max_age_seconds
+        self.candidate = None
+        self.building = False
+        self.built = Event() # set once the build in flight finishes, whether or not it produced a candidate
+        self.token = CancellationToken() # cancelled on invalidate so a build that was already running is thrown away
+        self.lock = Lock()
+
+    def is_fresh(self, candidate, within_seconds=0.0):
+        return candidate.get_age_seconds() + within_seconds < self.max_age_seconds
+
+    # starts building a candidate unless one is already building or will still be fresh in within_seconds
+    def ensure_candidate(self, within_seconds=0.0):
+        with self.lock:
+            if self.building or (self.candidate is not None and self.is_fresh(self.candidate, within_seconds)):
+                return
+            self.building = True
+            self.built = Event()
+            token = self.token
+        Thread(target=self.build, args=(token,), name='mood_prefetch', daemon=True).start()
+
+    def build(self, token):
+        try:
+            start = time.monotonic()
+            # reasoning is not streamed, the candidate is complete by the time it is used
+            candidate = self.pipeline.build(token, stream=False)
+            if candidate.playlist is None:
+                return
+            with self.lock:
+                if token.is_cancelled():
+                    return
+                self.candidate = candidate
+            logger.info("Prepared next mood {0} with playlist {1} in {2:.2f}s".format(candidate.mood, candidate.playlist['name'], time.monotonic() - start))
+        except MoodPipelineCancelled:
+            logger.debug("Preparing the next mood was cancelled")
+        except Exception as e:
+            logger.warning("Preparing the next mood failed due to {0}".format(e))
+        finally:
+            with self.lock:
+                self.building = False
+                self.built.set()
+
+    # hands over the candidate if it is still fresh, each candidate is only used once
+    # a build already under way is waited on so the mood change does not run a second pipeline next to it
+    def take(self, wait_seconds=TAKE_WAIT_SECONDS):
+        with self.lock:
+            built = self.built if self.building and self.candidate is None else None
+        if built is not None and not built.wait(wait_seconds):
+            logger.debug("Prepared mood still building after {0}s, not waiting any longer".format(wait_seconds))
+        with self.lock:
+            candidate, self.candidate = self.candidate, None
+        if candidate is not None and not self.is_fresh(candidate):
+            logger.debug("Prepared mood {0} is stale, dropping it".format(candidate.mood))
+            return None
+        return candidate
+
+    def invalidate(self):
+        with self.lock:
+            self.candidate = None
+            self.token.cancel()
+            self.token = CancellationToken()
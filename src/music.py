@@ -5,9 +5,84 @@ from spotipy.oauth2 import SpotifyOAuth, CacheFileHandler
 from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
 import logging, os
+import time
+from threading import Lock, Event
+
+from llm_memo import memoize_chain, memoized_stream_split
+from playlist_index import PlaylistIndex
+from playlist_ranker import PlaylistRanker
+from history import get_history
+from metrics import metrics
 
 logger = logging.getLogger('beba')
 
+
+# short lived snapshot of the spotify playback state
+# concurrent readers share a single in-flight currently_playing() request
+class PlaybackState:
+
+    TTL_SECONDS = 2.0
+
+    def __init__(self, fetch, ttl_seconds=TTL_SECONDS):
+        self.fetch = fetch
+        self.ttl_seconds = ttl_seconds
+        self.state = None
+        self.fetched_at = None
+        self.in_flight = None
+        self.lock = Lock()
+
+    def get(self):
+        with self.lock:
+            if self.fetched_at is not None and time.monotonic() - self.fetched_at < self.ttl_seconds:
+                return self.state
+            in_flight = self.in_flight
+            if in_flight is None:
+                self.in_flight = Event()
+        if in_flight is not None:
+            # another thread is already fetching, wait for it and share its result
+            in_flight.wait()
+            with self.lock:
+                return self.state
+        try:
+            state = self.fetch()
+            with self.lock:
+                self.state = state
+                self.fetched_at = time.monotonic()
+            return state
+        finally:
+            with self.lock:
+                in_flight, self.in_flight = self.in_flight, None
+            in_flight.set()
+
+    # applies a change we made ourselves so the next read does not need a request
+    def update(self, **changes):
+        with self.lock:
+            if self.state is None:
+                self.fetched_at = None
+                return
+            self.state.update(changes)
+            self.fetched_at = time.monotonic()
+
+    def invalidate(self):
+        with self.lock:
+            self.fetched_at = None
+
+playlist_index = None
+playlist_index_lock = Lock()
+
+# one index shared by every Music instance so zones do not overwrite each other's file
+def get_playlist_index(spotify):
+    global playlist_index
+    with playlist_index_lock:
+        if playlist_index is None and os.getenv('PLAYLIST_INDEX_PATH'):
+            playlist_index = PlaylistIndex(
+                os.getenv('PLAYLIST_INDEX_PATH'),
+                lambda uri: spotify.playlist(uri, fields='uri,name'),
+                max_entries=int(os.getenv('PLAYLIST_INDEX_MAX_ENTRIES')) if os.getenv('PLAYLIST_INDEX_MAX_ENTRIES') is not None else PlaylistIndex.MAX_ENTRIES,
+                match_cutoff=float(os.getenv('PLAYLIST_INDEX_MATCH_CUTOFF')) if os.getenv('PLAYLIST_INDEX_MATCH_CUTOFF') is not None else PlaylistIndex.MATCH_CUTOFF
+            )
+        return playlist_index
+
 class Music:
 
     SEARCH_BY_MOOD_PROMPT = """
@@ -23,21 +98,40 @@ class Music:
 
     device = None
     playlist = None
+    playlist_ranker = None
     search_query = ''
     search_query_reason = ''
+    search_query_reason_future = None
+    history = None
+    last_track_key = None
+    REPEAT_SECONDS = 7 * 24 * 60 * 60 # playlists started this recently are passed over when another matches
+
+    CACHE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../.cache')
 
-    def __init__(self, llm):
-        self.spotify = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=self.USER_SCOPE, 
-                                                                 open_browser=False,
-                                                                 cache_handler=CacheFileHandler(
-                                                                    cache_path=os.path.join(os.path.abspath(os.path.dirname(__file__)), '../.cache'))))
+    # multi zone mode passes in a spotify client shared by every zone on the same account
+    def __init__(self, llm, spotify=None, device_name=None, device_id=None):
+        self.spotify = spotify if spotify is not None else self.create_spotify_client()
         self.llm = llm
         self.search_by_mood_template = PromptTemplate(
             input_variables=self.SEARCH_BY_MOOD_VARS,
             template=self.SEARCH_BY_MOOD_PROMPT
         )
-        self.search_by_mood_chain = LLMChain(llm=self.llm, prompt=self.search_by_mood_template)
-        self.setup_device_id(os.getenv('SPOTIFY_DEVICE_NAME'), os.getenv('SPOTIFY_DEVICE_ID'))
+        self.search_by_mood_chain = memoize_chain(LLMChain(llm=self.llm, prompt=self.search_by_mood_template), 'search_query', lambda text: ':' in text)
+        self.search_by_mood_stream = self.search_by_mood_template | self.llm
+        self.history = get_history()
+        self.repeat_seconds = 60.0 * 60.0 * float(os.getenv('HISTORY_REPEAT_HOURS')) if os.getenv('HISTORY_REPEAT_HOURS') is not None else self.REPEAT_SECONDS
+        self.playback = PlaybackState(self.fetch_playback)
+        if os.getenv('PLAYLIST_SEARCH_RANKED') is not None and os.getenv('PLAYLIST_SEARCH_RANKED').lower() == "true":
+            self.playlist_ranker = PlaylistRanker(self.spotify, float(os.getenv('PLAYLIST_SEARCH_BUDGET_SECONDS')) if os.getenv('PLAYLIST_SEARCH_BUDGET_SECONDS') is not None else PlaylistRanker.BUDGET_SECONDS)
+        self.playlist_index = get_playlist_index(self.spotify)
+        self.setup_device_id(device_name if device_name is not None else os.getenv('SPOTIFY_DEVICE_NAME'), device_id if device_id is not None else os.getenv('SPOTIFY_DEVICE_ID'))
+
+    @classmethod
+    def create_spotify_client(cls, cache_path=CACHE_PATH, requests_session=True):
+        return spotipy.Spotify(auth_manager=SpotifyOAuth(scope=cls.USER_SCOPE, 
+                                                         open_browser=False,
+                                                         cache_handler=CacheFileHandler(cache_path=cache_path)),
+                               requests_session=requests_session)
 
     def setup_device_id(self, device_name, backup_device_id=None):
         devices = self.spotify.devices()
@@ -50,87 +144,164 @@ class Music:
                 self.device = device
         if self.device is None:
             logging.error("Could not find a device with name {0}".format(device_name))
-            if backup_device_id is not None:
+            if backup_device_id:
                 logging.warning("Will use backup device id {0} instead.".format(backup_device_id))
                 self.device = {'id' : backup_device_id, 'name': device_name}
 
-    def find_playlist(self, search_query):
-        results = self.spotify.search(q=search_query, type='playlist')
-        if results is not None and len(results) > 0:
-            playlist = results['playlists']['items'][0]
-            logger.debug("Found playlist: {0}".format(playlist))
-            return playlist
-        else:
-            logger.error("Could not find a playlist for this search query {0}".format(search_query))
-            return None
+    # answers from the local playlist index when a close match exists, otherwise searches spotify
+    def find_playlist(self, search_query, mood=None):
+        with metrics.span('spotify.find_playlist'):
+            recently_played = self.get_recently_played()
+            if self.playlist_index is not None:
+                playlist = self.playlist_index.lookup(search_query, exclude=recently_played)
+                if playlist is not None:
+                    return playlist
+            playlist = self.find_ranked_playlist(search_query, recently_played) if self.playlist_ranker is not None else None
+            if playlist is not None:
+                if self.playlist_index is not None:
+                    self.playlist_index.add(playlist, search_query, mood)
+                return playlist
+            try:
+                with metrics.span('spotify.search'):
+                    results = self.spotify.search(q=search_query, type='playlist')
+            except Exception as e:
+                # keep mood changes working through spotify slowdowns with a looser local match
+                playlist = self.playlist_index.lookup(search_query, PlaylistIndex.FALLBACK_MATCH_CUTOFF) if self.playlist_index is not None else None
+                if playlist is None:
+                    raise e
+                logger.warning("Spotify search failed due to {0}, using indexed playlist {1}".format(e, playlist['name']))
+                return playlist
+            # spotify can return null items for playlists that are no longer available
+            playlists = [item for item in results['playlists']['items'] if item is not None and item.get('uri')] if results is not None and results.get('playlists') is not None else []
+            if len(playlists) > 0:
+                # a repeat is still better than nothing when every result was played recently
+                playlist = next((item for item in playlists if item['uri'] not in recently_played), playlists[0])
+                logger.debug("Found playlist: {0}".format(playlist))
+                if self.playlist_index is not None:
+                    self.playlist_index.add(playlist, search_query, mood)
+                return playlist
+            else:
+                logger.error("Could not find a playlist for this search query {0}".format(search_query))
+                return None
 
-    def get_search_query_from_mood(self, mood, retry=True):
+    # the single search below stays as the fallback when ranking finds nothing in time
+    def find_ranked_playlist(self, search_query, recently_played=()):
         try:
-            logger.debug("Getting search query based on mood {0}".format(mood))
-            llm_response = self.search_by_mood_chain.invoke({'mood' : mood})
-            logger.debug("LLM response: {0}".format(llm_response))
-            if len(llm_response['text'].split(':')) > 2: # handling extra colons
-                split_response = llm_response['text'].split(':')
-                llm_response['text'] = split_response[0] + '-'.join(split_response[1:])
-            self.search_query, self.search_query_reason = [x.strip() for x in llm_response['text'].split(':')]
-            return self.search_query
+            with metrics.span('spotify.ranked_search'):
+                return self.playlist_ranker.find(search_query, recently_played)
         except Exception as e:
-            if retry:
-                logger.warning("Failed to get search query from mood due to {0}, retrying...".format(e))
-                return self.get_search_query_from_mood(mood, retry=False)
-            logger.error(e)
-            raise e
-    
-    def start_playlist_based_on_mood(self, mood):
-        search_query = self.get_search_query_from_mood(mood)
-        self.playlist = self.find_playlist(search_query)
-        if self.playlist is not None and self.device is not None:
-            logger.info("Starting playback of playlist {0}...".format(self.playlist))
-            self.spotify.start_playback(context_uri=self.playlist['uri'], device_id=self.device['id'])
-            self.play()
+            logger.warning("Ranked playlist search failed due to {0}, falling back to a single search".format(e))
+            return None
+
+    def get_recently_played(self):
+        return set(self.history.get_played_playlists(self.repeat_seconds)) if self.history is not None else set()
+
+    # works out a search query and its reasoning without changing the current one
+    def generate_search_query(self, mood):
+        with metrics.span('llm.search_query'):
+            llm_response = self.search_by_mood_chain.invoke({'mood' : mood})
+        logger.debug("LLM response: {0}".format(llm_response))
+        if len(llm_response['text'].split(':')) > 2: # handling extra colons
+            split_response = llm_response['text'].split(':')
+            llm_response['text'] = split_response[0] + '-'.join(split_response[1:])
+        search_query, search_query_reason = [x.strip() for x in llm_response['text'].split(':')]
+        return search_query, search_query_reason
+
+    # returns the search query as soon as it arrives and a Future for the reasoning that is still streaming in
+    def stream_search_query(self, mood):
+        with metrics.span('llm.search_query_stream_answer'):
+            return memoized_stream_split(self.search_by_mood_chain, self.search_by_mood_stream, {'mood' : mood})
+
+    def set_streamed_search_query_reason(self, future):
+        # a newer search may have started streaming since, its reasoning wins
+        if future is self.search_query_reason_future and future.exception() is None:
+            self.search_query_reason = future.result()
+            logger.debug("Search query reasoning: {0}".format(self.search_query_reason))
+
+    # starts a playlist that was already found, such as one prepared ahead of time
+    def start_playlist(self, playlist, search_query, search_query_reason, search_query_reason_future=None):
+        self.set_playlist(playlist, search_query, search_query_reason, search_query_reason_future)
+        self.play_playlist()
+
+    # only swaps the state, a reasoning future fills in the search reasoning once it finishes streaming
+    def set_playlist(self, playlist, search_query, search_query_reason, search_query_reason_future=None):
+        self.search_query, self.search_query_reason = search_query, search_query_reason
+        self.search_query_reason_future = search_query_reason_future
+        if search_query_reason_future is not None:
+            search_query_reason_future.add_done_callback(self.set_streamed_search_query_reason)
+        self.playlist = playlist
+
+    # start_playback with a context already plays it, no separate resume is needed
+    def play_playlist(self):
+        playlist = self.playlist
+        if playlist is not None and self.device is not None:
+            logger.info("Starting playback of playlist {0}...".format(playlist))
+            with metrics.span('spotify.start_playback'):
+                self.spotify.start_playback(context_uri=playlist['uri'], device_id=self.device['id'])
+            self.playback.invalidate()
+            if self.playlist_index is not None:
+                self.playlist_index.mark_played(playlist)
         else:
             logger.error("Could not start playback as playlist or device is not present.")
     
     def play_pause(self):
-        logger.debug(self.spotify.currently_playing())
+        playback = self.playback.get()
+        logger.debug(playback)
         if self.device is not None:
-            if self.spotify.currently_playing() is not None and self.spotify.currently_playing()['is_playing']:
-                logger.info("Pausing playback...")
-                self.spotify.pause_playback(device_id=self.device['id'])
+            if playback is not None and playback['is_playing']:
+                self.pause()
             else:
-                logger.info("Resuming playback...")
-                self.spotify.start_playback(device_id=self.device['id'])
+                self.play()
 
     def play(self):
         if self.device is not None:
             logger.info("Resuming playback...")
             self.spotify.start_playback(device_id=self.device['id'])
+            self.playback.update(is_playing=True)
 
     def pause(self):
         if self.device is not None:
             logger.info("Pausing playback...")
             self.spotify.pause_playback(device_id=self.device['id'])
+            self.playback.update(is_playing=False)
 
-    def next_track(self):
+    def next_track(self, count=1):
         if self.device is not None:
-            if self.spotify.currently_playing() is not None:
-                logger.info("Skipping to next track...")
-                self.spotify.next_track()
+            if self.playback.get() is not None:
+                logger.info("Skipping {0} track(s) forward...".format(count))
+                for _ in range(count):
+                    self.spotify.next_track(device_id=self.device['id'])
+                self.playback.invalidate()
 
-    def previous_track(self):
+    def previous_track(self, count=1):
         if self.device is not None:
-            if self.spotify.currently_playing() is not None:
-                logger.info("Skipping to previous track...")
-                self.spotify.previous_track()
+            if self.playback.get() is not None:
+                logger.info("Skipping {0} track(s) back...".format(count))
+                for _ in range(count):
+                    self.spotify.previous_track(device_id=self.device['id'])
+                self.playback.invalidate()
+
+    # every playback read notes a new track in the history, tracks are seen as often as the screen or keys ask
+    def fetch_playback(self):
+        playback = self.spotify.currently_playing()
+        track = playback.get('item') if playback is not None else None
+        if self.history is not None and track is not None:
+            track_key = track.get('uri') or track.get('name')
+            if track_key != self.last_track_key:
+                self.last_track_key = track_key
+                self.history.record_track(track)
+        return playback
+
+    def get_current_track(self):
+        playback = self.playback.get() if self.device is not None else None
+        if playback is not None and playback.get('item') is not None:
+            return playback['item']
+        return None
 
     def get_artist(self):
-        if self.device is not None and self.spotify.currently_playing() is not None:
-            return self.spotify.currently_playing()['item']['artists'][0]['name']
-        else:
-            return ""
+        track = self.get_current_track()
+        return track['artists'][0]['name'] if track is not None else ""
 
     def get_track_name(self):
-        if self.device is not None and self.spotify.currently_playing() is not None:
-            return self.spotify.currently_playing()['item']['name']
-        else:
-            return ""
+        track = self.get_current_track()
+        return track['name'] if track is not None else ""
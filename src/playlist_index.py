@@ -0,0 +1,112 @@
+# Copyright Michael Kukar 2023
+
+import logging
+import re
+import time
+from threading import Lock, Thread
+
+from cache import TTLCache
+from metrics import metrics
+
+logger = logging.getLogger('beba')
+
+# local index of every playlist found or played so similar search queries can skip the spotify search
+# each entry keeps the character trigrams of its query as a cheap similarity signature
+class PlaylistIndex:
+
+    MAX_ENTRIES = 500
+    MATCH_CUTOFF = 0.6 # trigram similarity (0-1) needed to reuse a playlist instead of searching
+    FALLBACK_MATCH_CUTOFF = 0.3 # looser similarity accepted when the spotify search fails
+    REFRESH_SECONDS = 7 * 24 * 60 * 60 # how long before a reused playlist is checked again on spotify
+
+    def __init__(self, path, fetch_playlist, max_entries=MAX_ENTRIES, match_cutoff=MATCH_CUTOFF, refresh_seconds=REFRESH_SECONDS):
+        self.fetch_playlist = fetch_playlist
+        self.match_cutoff = match_cutoff
+        self.refresh_seconds = refresh_seconds
+        # uri -> {'name', 'query', 'mood', 'signature', 'plays', 'refreshed_at'}, least recently used go first once full
+        # entries are never changed in place, so a save in the background never sees one half updated
+        self.index = TTLCache(max_entries, path)
+        self.refreshing = set()
+        self.lock = Lock()
+
+    @staticmethod
+    def get_signature(text):
+        words = re.sub('[^a-z0-9 ]', ' ', text.lower()).split()
+        return set([gram for word in words for gram in [' {0} '.format(word)[i:i + 3] for i in range(len(word))]])
+
+    @staticmethod
+    def get_similarity(signature, other_signature):
+        if len(signature) == 0 or len(other_signature) == 0:
+            return 0.0
+        return len(signature & other_signature) / float(len(signature | other_signature))
+
+    # returns the indexed playlist closest to the query if it is similar enough, otherwise None
+    # playlists in exclude are skipped, such as ones played recently
+    # a hit is only noted in memory, lookups never write the index
+    def lookup(self, search_query, cutoff=None, exclude=()):
+        cutoff = cutoff if cutoff is not None else self.match_cutoff
+        signature = self.get_signature(search_query)
+        best_uri, best_similarity = None, 0.0
+        for uri, entry in self.index.items():
+            if uri in exclude:
+                continue
+            similarity = self.get_similarity(signature, set(entry['signature']))
+            if similarity > best_similarity:
+                best_uri, best_similarity = uri, similarity
+        metrics.cache('playlist_index', best_uri is not None and best_similarity >= cutoff)
+        if best_uri is None or best_similarity < cutoff:
+            logger.debug("No indexed playlist for search query {0}".format(search_query))
+            return None
+        entry = self.index.get(best_uri)
+        if entry is None:
+            return None
+        logger.debug("Using indexed playlist {0} ({1:.0%} similar) for search query {2}".format(entry['name'], best_similarity, search_query))
+        if time.time() - entry['refreshed_at'] > self.refresh_seconds:
+            self.refresh_in_background(best_uri)
+        return {'uri': best_uri, 'name': entry['name']}
+
+    def add(self, playlist, search_query, mood=None):
+        with self.lock:
+            entry = self.index.get(playlist['uri']) or {'plays': 0, 'mood': mood}
+            self.index.set(playlist['uri'], dict(entry,
+                name=playlist['name'],
+                query=search_query,
+                mood=mood if mood is not None else entry['mood'],
+                signature=sorted(self.get_signature(search_query)),
+                refreshed_at=time.time()
+            ))
+
+    def mark_played(self, playlist):
+        with self.lock:
+            entry = self.index.get(playlist['uri'])
+            if entry is not None:
+                self.index.set(playlist['uri'], dict(entry, plays=entry['plays'] + 1))
+
+    # makes sure a playlist that is being reused still exists on spotify, without holding up playback
+    def refresh_in_background(self, uri):
+        with self.lock:
+            if uri in self.refreshing:
+                return
+            self.refreshing.add(uri)
+        Thread(target=self.refresh, args=(uri,), name='playlist_index_refresh', daemon=True).start()
+
+    def refresh(self, uri):
+        try:
+            playlist = self.fetch_playlist(uri)
+            with self.lock:
+                entry = self.index.get(uri)
+                if entry is not None:
+                    self.index.set(uri, dict(entry, name=playlist['name'], refreshed_at=time.time()))
+        except Exception as e:
+            if getattr(e, 'http_status', None) == 404:
+                logger.info("Indexed playlist {0} no longer exists, removing it".format(uri))
+                self.index.delete(uri)
+            else:
+                logger.warning("Could not refresh indexed playlist {0} due to {1}".format(uri, e))
+        finally:
+            with self.lock:
+                self.refreshing.discard(uri)
+
+    # writes out which playlists were used since the last change, called on exit
+    def flush(self):
+        self.index.flush()
@@ -0,0 +1,98 @@
+# Copyright Michael Kukar 2023
+
+import logging
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger('beba')
+
+# searches several result pages and a broader variant of the query at once and picks the best playlist
+# anything that has not answered when the latency budget runs out is ignored
+class PlaylistRanker:
+
+    BUDGET_SECONDS = 2.0
+    PAGE_SIZE = 10
+    PAGES = 2
+    MIN_TRACKS = 10 # playlists with fewer tracks are treated as junk
+    FOLLOWER_LOOKUPS = 3 # follower counts need a request per playlist, only the top few are looked up
+    BROAD_QUERY_MIN_WORDS = 4
+    BROAD_QUERY_RANK_PENALTY = 5 # results of the broader query rank behind the exact ones
+    RECENTLY_PLAYED_RANK_PENALTY = 10 # recently played playlists are only picked when nothing else is close
+    SPOTIFY_OWNER_ID = 'spotify'
+
+    def __init__(self, spotify, budget_seconds=BUDGET_SECONDS):
+        self.spotify = spotify
+        self.budget_seconds = budget_seconds
+
+    # (query, offset, rank penalty) for every search sent to spotify
+    def get_searches(self, search_query):
+        searches = [(search_query, page * self.PAGE_SIZE, 0) for page in range(self.PAGES)]
+        words = search_query.split()
+        if len(words) >= self.BROAD_QUERY_MIN_WORDS:
+            searches.append((' '.join(words[:len(words) // 2 + 1]), 0, self.BROAD_QUERY_RANK_PENALTY))
+        return searches
+
+    def search(self, query, offset):
+        results = self.spotify.search(q=query, type='playlist', limit=self.PAGE_SIZE, offset=offset)
+        return results['playlists']['items'] if results is not None and results.get('playlists') is not None else []
+
+    def get_followers(self, playlist):
+        return self.spotify.playlist(playlist['uri'], fields='followers.total')['followers']['total']
+
+    # None for playlists that are unavailable or too small to play
+    def score(self, playlist, rank, followers=None):
+        if playlist is None or not playlist.get('uri'):
+            return None
+        track_count = (playlist.get('tracks') or {}).get('total') or 0
+        if track_count < self.MIN_TRACKS:
+            return None
+        score = min(math.log10(track_count), 2.0) - 0.1 * rank
+        if (playlist.get('owner') or {}).get('id') == self.SPOTIFY_OWNER_ID:
+            score += 1.0
+        if followers is not None:
+            score += 0.5 * math.log10(followers + 1)
+        return score
+
+    # returns the best playlist found within the budget, or None so the caller can fall back to a plain search
+    def find(self, search_query, recently_played=()):
+        deadline = time.monotonic() + self.budget_seconds
+        searches = self.get_searches(search_query)
+        executor = ThreadPoolExecutor(max_workers=max(len(searches), self.FOLLOWER_LOOKUPS), thread_name_prefix='playlist_search')
+        try:
+            candidates = {} # uri -> (playlist, rank)
+            pending = {executor.submit(self.search, query, offset): offset + penalty for query, offset, penalty in searches}
+            while pending and time.monotonic() < deadline:
+                done, _ = wait(pending, timeout=deadline - time.monotonic(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    first_rank = pending.pop(future)
+                    try:
+                        items = future.result()
+                    except Exception as e:
+                        logger.warning("Playlist search failed due to {0}".format(e))
+                        continue
+                    for position, playlist in enumerate(items):
+                        if self.score(playlist, first_rank + position) is None:
+                            continue
+                        rank = first_rank + position + (self.RECENTLY_PLAYED_RANK_PENALTY if playlist['uri'] in recently_played else 0)
+                        if playlist['uri'] not in candidates or candidates[playlist['uri']][1] > rank:
+                            candidates[playlist['uri']] = (playlist, rank)
+            if len(candidates) == 0:
+                logger.debug("No usable playlists for {0} within {1}s".format(search_query, self.budget_seconds))
+                return None
+            ranked = sorted(candidates.values(), key=lambda candidate: self.score(*candidate), reverse=True)
+            # break ties between the leaders on followers if there is budget left
+            followers = {}
+            follower_futures = {executor.submit(self.get_followers, playlist): playlist['uri'] for playlist, _ in ranked[:self.FOLLOWER_LOOKUPS]}
+            done, _ = wait(follower_futures, timeout=max(0.0, deadline - time.monotonic()))
+            for future in done:
+                try:
+                    followers[follower_futures[future]] = future.result()
+                except Exception as e:
+                    logger.debug("Could not get followers due to {0}".format(e))
+            best_playlist, _ = max(ranked[:self.FOLLOWER_LOOKUPS], key=lambda candidate: self.score(candidate[0], candidate[1], followers.get(candidate[0]['uri'])))
+            logger.debug("Ranked {0} playlists for {1}, picked {2}".format(len(candidates), search_query, best_playlist['name']))
+            return best_playlist
+        finally:
+            # never wait on a slow request, it finishes in the background
+            executor.shutdown(wait=False, cancel_futures=True)
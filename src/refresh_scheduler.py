@@ -0,0 +1,63 @@
+# Copyright Michael Kukar 2023
+
+import logging
+from PIL import ImageChops
+
+logger = logging.getLogger('beba')
+
+# decides between a full and a partial e-paper refresh by diffing against the last frame sent
+# full refreshes flash the whole panel but clear ghosting, so one is forced every so often
+class RefreshScheduler:
+
+    NONE = 'none'
+    PARTIAL = 'partial'
+    FULL = 'full'
+
+    FULL_REFRESH_EVERY = 10 # partial refreshes allowed before a full one clears ghosting
+    PARTIAL_MAX_AREA_FRACTION = 0.5 # changes covering more of the panel than this use a full refresh
+    DIFF_BANDS = 8 # frame is split into horizontal bands so separate changes get separate boxes
+
+    def __init__(self, full_refresh_every=FULL_REFRESH_EVERY, partial_max_area_fraction=PARTIAL_MAX_AREA_FRACTION, partial_supported=True):
+        self.full_refresh_every = full_refresh_every
+        self.partial_max_area_fraction = partial_max_area_fraction
+        self.partial_supported = partial_supported
+        self.last_frame = None
+        self.partial_count = 0
+
+    # bounding boxes (left, top, right, bottom) of every region that differs from the last frame
+    def get_changed_regions(self, frame):
+        diff = ImageChops.logical_xor(frame.convert('1'), self.last_frame.convert('1'))
+        width, height = diff.size
+        band_height = -(-height // self.DIFF_BANDS)
+        regions = []
+        for top in range(0, height, band_height):
+            bottom = min(top + band_height, height)
+            bbox = diff.crop((0, top, width, bottom)).getbbox()
+            if bbox is not None:
+                regions.append((bbox[0], top + bbox[1], bbox[2], top + bbox[3]))
+        return regions
+
+    def plan(self, frame, force_full=False):
+        if force_full or self.last_frame is None or self.last_frame.size != frame.size or not self.partial_supported:
+            return self.FULL
+        regions = self.get_changed_regions(frame)
+        if len(regions) == 0:
+            return self.NONE
+        changed_area = sum([(right - left) * (bottom - top) for left, top, right, bottom in regions])
+        changed_fraction = changed_area / float(frame.size[0] * frame.size[1])
+        logger.debug("Changed regions {0} cover {1:.0%} of the panel".format(regions, changed_fraction))
+        if self.partial_count >= self.full_refresh_every or changed_fraction > self.partial_max_area_fraction:
+            return self.FULL
+        return self.PARTIAL
+
+    def commit(self, frame, refresh):
+        self.last_frame = frame
+        if refresh == self.FULL:
+            self.partial_count = 0
+        elif refresh == self.PARTIAL:
+            self.partial_count += 1
+
+    # panel was cleared outside of the scheduler, next frame needs a full refresh
+    def reset(self):
+        self.last_frame = None
+        self.partial_count = 0
@@ -0,0 +1,70 @@
+# Copyright Michael Kukar 2023
+
+import heapq
+import itertools
+import logging
+import time
+from threading import Condition, Thread
+
+logger = logging.getLogger('beba')
+
+# one thread that runs named jobs at monotonic times, sleeping until the next one is due
+# jobs are passed the time they were due so periodic jobs can re-arm from it without drifting
+class Scheduler:
+
+    def __init__(self):
+        self.queue = [] # (due, sequence, name), a job rescheduled under the same name leaves a stale entry that is skipped
+        self.jobs = {} # name -> (due, sequence, job)
+        self.sequence = itertools.count()
+        self.condition = Condition()
+        self.stopped = False
+        self.thread = None
+
+    # replaces any job already scheduled under the same name
+    def schedule_at(self, due, name, job):
+        with self.condition:
+            sequence = next(self.sequence)
+            self.jobs[name] = (due, sequence, job)
+            heapq.heappush(self.queue, (due, sequence, name))
+            self.condition.notify()
+        logger.debug("Scheduled {0} in {1:.1f}s".format(name, due - time.monotonic()))
+
+    def schedule_in(self, seconds, name, job):
+        self.schedule_at(time.monotonic() + seconds, name, job)
+
+    def cancel(self, name):
+        with self.condition:
+            self.jobs.pop(name, None)
+
+    def get_due(self, name):
+        with self.condition:
+            return self.jobs[name][0] if name in self.jobs else None
+
+    def start(self):
+        self.thread = Thread(target=self.run, args=(), name='scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopped:
+                        return
+                    # drop entries for jobs that were cancelled or rescheduled
+                    while self.queue and self.jobs.get(self.queue[0][2], (None, None))[1] != self.queue[0][1]:
+                        heapq.heappop(self.queue)
+                    if self.queue and self.queue[0][0] <= time.monotonic():
+                        due, _, name = heapq.heappop(self.queue)
+                        job = self.jobs.pop(name)[2]
+                        break
+                    self.condition.wait(timeout=self.queue[0][0] - time.monotonic() if self.queue else None)
+            try:
+                job(due)
+            except Exception as e:
+                logger.error("Scheduled job {0} failed".format(name))
+                logger.error(e)
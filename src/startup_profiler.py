@@ -0,0 +1,39 @@
+# Copyright Michael Kukar 2023
+
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+# records how long each import and init step takes during startup
+class StartupProfiler:
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.spans = [] # (name, seconds taken)
+        self.milestones = [] # (name, seconds since start)
+        self.lock = Lock()
+
+    @contextmanager
+    def span(self, name):
+        span_start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.spans.append((name, time.monotonic() - span_start))
+
+    def mark(self, name):
+        with self.lock:
+            self.milestones.append((name, time.monotonic() - self.start))
+
+    def report(self):
+        with self.lock:
+            lines = ["Startup time report:"]
+            for name, seconds in self.spans:
+                lines.append("\t{0:<28} {1:>8.3f}s".format(name, seconds))
+            for name, seconds in self.milestones:
+                lines.append("\t{0:<28} {1:>8.3f}s after start".format(name, seconds))
+        return lines
+
+# created on first import so it measures from as early in startup as possible
+startup_profiler = StartupProfiler()
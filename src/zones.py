@@ -0,0 +1,225 @@
+# Copyright Michael Kukar 2023
+
+import logging
+import os
+import time
+from concurrent.futures import Future
+from threading import Thread, Lock
+
+from controller import Controller
+from mood_pipeline import MoodPipeline, CancellationToken
+from startup_profiler import startup_profiler
+
+logger = logging.getLogger('beba')
+
+# one room with its own spotify device, mood timer and playback state
+class Zone:
+
+    def __init__(self, name, location, music):
+        self.name = name
+        self.location = location
+        self.music = music
+        self.quiet_hours_handled = False
+        self.lock = Lock()
+
+
+# zones in the same location share one mood, worked out once for all of them
+class Location:
+
+    def __init__(self, name, mood, pipeline, shared_mood_seconds, history=None):
+        self.name = name
+        self.history = history
+        self.mood = mood
+        self.pipeline = pipeline
+        self.shared_mood_seconds = shared_mood_seconds
+        self.candidate_future = None
+        self.lock = Lock()
+
+    def is_fresh(self, future):
+        return future.exception() is None and future.result().get_age_seconds() <= self.shared_mood_seconds
+
+    # reuses the mood another zone here just worked out or is still working out, otherwise works out a new one
+    # only the zone that starts the build waits on it, the others get the future and are called back when it is done
+    def get_candidate(self):
+        with self.lock:
+            future = self.candidate_future
+            if future is not None and (not future.done() or self.is_fresh(future)):
+                return future
+            future = self.candidate_future = Future()
+        self.build(future)
+        return future
+
+    def build(self, future):
+        try:
+            candidate = self.pipeline.build(CancellationToken(), stream=False)
+            self.mood.set_mood(candidate.mood, candidate.mood_reason)
+            if self.history is not None:
+                self.history.record_mood(candidate.mood, candidate.mood_reason)
+            future.set_result(candidate)
+        except Exception as e:
+            future.set_exception(e)
+
+    # the next zone to ask works out a new mood
+    def invalidate(self):
+        with self.lock:
+            self.candidate_future = None
+
+
+# runs many zones from one process sharing the llm client, mood changer data and spotify http session
+# ZONES is a comma separated list of spotify device names, each optionally followed by @location and #account
+# for example ZONES=Kitchen@downstairs,Living Room@downstairs,Office@upstairs#office
+# zones with an account use their own spotify token cache (.cache-<account>) but still share connections
+class MultiZoneController(Controller):
+
+    DEFAULT_LOCATION = 'default'
+    # a zone reuses its location's mood if it was worked out less than this long ago
+    SHARED_MOOD_MINUTES = 5.0
+
+    def __init__(self, version):
+        super().__init__(version)
+        self.zones = []
+        self.locations = {}
+
+    @staticmethod
+    def parse_zones(zones_text):
+        zones = []
+        for zone_text in [x.strip() for x in zones_text.split(',') if x.strip()]:
+            zone_text, account = zone_text.split('#', 1) if '#' in zone_text else (zone_text, None)
+            device_name, location = zone_text.split('@', 1) if '@' in zone_text else (zone_text, MultiZoneController.DEFAULT_LOCATION)
+            zones.append((device_name.strip(), location.strip(), account.strip() if account is not None else None))
+        return zones
+
+    def setup_components(self):
+        try:
+            import requests
+            with startup_profiler.span('import langchain_openai'):
+                from langchain_openai import ChatOpenAI
+            with startup_profiler.span('import mood'):
+                from mood import Mood
+            with startup_profiler.span('import music'):
+                from music import Music
+            with startup_profiler.span('init ChatOpenAI'):
+                self.llm = self.create_llm(ChatOpenAI)
+            shared_mood_seconds = 60.0 * float(os.getenv('ZONE_SHARED_MOOD_MINUTES')) if os.getenv('ZONE_SHARED_MOOD_MINUTES') is not None else 60.0 * self.SHARED_MOOD_MINUTES
+            session = requests.Session()
+            spotify_clients = {} # account -> client
+            for device_name, location_name, account in self.parse_zones(os.getenv('ZONES')):
+                if account not in spotify_clients:
+                    cache_path = Music.CACHE_PATH if account is None else "{0}-{1}".format(Music.CACHE_PATH, account)
+                    spotify_clients[account] = Music.create_spotify_client(cache_path, session)
+                with startup_profiler.span('init zone {0}'.format(device_name)):
+                    music = Music(self.llm, spotify_clients[account], device_name, device_id='')
+                    self.history = music.history
+                    if location_name not in self.locations:
+                        mood = Mood(self.llm)
+                        mood.schedule_mood_changer_refreshes(self.scheduler, self.is_quiet_hours_now)
+                        # the first zone's music does the search, the playlist it finds is played in every zone of the location
+                        self.locations[location_name] = Location(location_name, mood, MoodPipeline(mood, music, self.mood_plan_mode), shared_mood_seconds, music.history)
+                    self.zones.append(Zone(device_name, self.locations[location_name], music))
+            logger.info("Set up {0} zones in {1} locations".format(len(self.zones), len(self.locations)))
+        except Exception as e:
+            logger.error("Failed to set up zones")
+            logger.error(e)
+            if not self.fast_startup:
+                raise e
+        finally:
+            startup_profiler.mark('components ready')
+            self.components_ready.set()
+            if self.fast_startup:
+                self.log_startup_report()
+
+    def start_mood_timer(self):
+        self.mood_timer_seconds = 60.0 * float(os.getenv('NEW_MOOD_TIMER_MINUTES')) if os.getenv('NEW_MOOD_TIMER_MINUTES') is not None else 60.0 * 60.0
+        self.scheduler.start()
+        # zones are not known until the components are ready, in fast startup that happens in the background
+        Thread(target=self.schedule_zones, args=(), name='schedule_zones', daemon=True).start()
+
+    def schedule_zones(self):
+        self.components_ready.wait()
+        for zone in self.zones:
+            self.scheduler.schedule_in(0.0, 'mood:{0}'.format(zone.name), lambda due, zone=zone: self.on_zone_mood_timer(zone, due))
+
+    def on_zone_mood_timer(self, zone, due):
+        self.request_zone_mood(zone)
+        self.scheduler.schedule_at(self.get_next_mood_due(due), 'mood:{0}'.format(zone.name), lambda next_due: self.on_zone_mood_timer(zone, next_due))
+
+    def request_zone_mood(self, zone):
+        self.dispatcher.dispatch('new_mood:{0}'.format(zone.name), lambda count: self.determine_zone_mood_and_play(zone))
+
+    # a mood picked by hand counts as a tick, so the timer does not change it again shortly after
+    def restart_zone_mood_timer(self, zone):
+        name = 'mood:{0}'.format(zone.name)
+        if self.scheduler.get_due(name) is not None:
+            self.scheduler.schedule_at(self.get_next_mood_due(time.monotonic()), name, lambda next_due: self.on_zone_mood_timer(zone, next_due))
+
+    def determine_zone_mood_and_play(self, zone):
+        started_at = time.monotonic()
+        if self.quiet_hours_enabled and self.check_if_quiet_hours():
+            with zone.lock:
+                if not zone.quiet_hours_handled:
+                    logger.info("Quiet hours, pausing music in {0}...".format(zone.name))
+                    zone.music.pause()
+                    zone.music.playlist = None
+                    zone.quiet_hours_handled = True
+            return
+        zone.location.get_candidate().add_done_callback(lambda future: self.play_zone_candidate(zone, future, started_at))
+
+    def play_zone_candidate(self, zone, future, started_at):
+        try:
+            candidate = future.result()
+            with zone.lock:
+                zone.quiet_hours_handled = False
+                zone.music.start_playlist(candidate.playlist, candidate.search_query, candidate.search_query_reason)
+            self.schedule_zone_track_poll(zone)
+            if self.history is not None and candidate.playlist is not None:
+                self.history.record_playlist(candidate.playlist, time.monotonic() - started_at)
+            print("{0} | MOOD: {1} | PLAYLIST: {2}".format(zone.name, candidate.mood, candidate.playlist['name'] if candidate.playlist is not None else "None"))
+        except Exception as e:
+            logger.error("Failed to determine new mood for {0}".format(zone.name))
+            logger.error(e)
+
+    def skip_zone_track(self, zone, skip, count):
+        skip(count)
+        self.schedule_zone_track_poll(zone)
+
+    def schedule_zone_track_poll(self, zone):
+        self.schedule_track_poll(music=zone.music, name='track:{0}'.format(zone.name))
+
+    # keys control every zone at once
+    def on_keypress(self, key):
+        logger.debug("Pressed key {0}".format(key))
+        if key == self.QUIT_KEY:
+            logger.info("Exiting...")
+            self.cleanup_and_exit()
+        elif key == self.CHANGE_MOOD_KEY:
+            logger.info("Determining new mood in every zone...")
+            # dropped before any zone asks, so every zone in a location shares the one new mood
+            for location in self.locations.values():
+                location.invalidate()
+            for zone in self.zones:
+                self.request_zone_mood(zone)
+                self.restart_zone_mood_timer(zone)
+        elif key == self.PLAY_PAUSE_KEY:
+            for zone in self.zones:
+                self.dispatcher.dispatch('play_pause:{0}'.format(zone.name), lambda count, zone=zone: zone.music.play_pause() if count % 2 == 1 else None)
+        elif key == self.NEXT_KEY:
+            for zone in self.zones:
+                self.dispatcher.dispatch('next_track:{0}'.format(zone.name), lambda count, zone=zone: self.skip_zone_track(zone, zone.music.next_track, count))
+        elif key == self.PREV_KEY:
+            for zone in self.zones:
+                self.dispatcher.dispatch('prev_track:{0}'.format(zone.name), lambda count, zone=zone: self.skip_zone_track(zone, zone.music.previous_track, count))
+        elif key == self.INFO_KEY:
+            for location in self.locations.values():
+                print("{0} Mood Reasoning: {1}".format(location.name, location.mood.current_mood_reason))
+
+    def cleanup_and_exit(self):
+        for zone in self.zones:
+            try:
+                zone.music.pause()
+            except Exception as e:
+                logger.warning("Could not pause {0} due to {1}".format(zone.name, e))
+        # every zone shares the one playlist index
+        if len(self.zones) > 0 and self.zones[0].music.playlist_index is not None:
+            self.zones[0].music.playlist_index.flush()
+        self.music = None
+        super().cleanup_and_exit()